@@ -1,4 +1,7 @@
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
+from typing import Optional
 
 from discord import Member, VoiceChannel
 from flask import Response, request, g
@@ -6,14 +9,14 @@ from flask.blueprints import Blueprint
 from pydantic import ValidationError
 
 import global_state
-import utils
 from api_models import PlaySongModel
-import discord
 from database.db_controller import database, WebKeyStatus
 from bot.song_generators import generate_youtube_song
 
 bp = Blueprint('bp', __name__)
 
+MEMBER_LOOKUP_TIMEOUT = 10  # Seconds a request waits for the bot to look a member up, fetching it from discord included
+
 
 @bp.errorhandler(ValidationError)
 def handle_validation_error(err: ValidationError):
@@ -26,7 +29,7 @@ def auth_key():
         key = request.cookies.get('key')
         if key is None:
             return "No key", 403
-        with database:
+        with database.read():
             is_auth, key_status = database.auth_key(key)
 
         if not is_auth:
@@ -36,7 +39,7 @@ def auth_key():
 
 @bp.get('/keygen/<token>')
 def validate_key(token: str):
-    with database:
+    with database.read():
         status = database.get_web_key_with_token(token)
 
     if status is None:
@@ -56,7 +59,7 @@ def validate_key(token: str):
 @bp.get('/api/guilds')
 def get_guilds():
     user: WebKeyStatus = g.user
-    with database:
+    with database.read():
         guild_ids = database.get_all_user_servers(user.id)
 
     guilds = [
@@ -75,7 +78,7 @@ def get_guilds():
 @bp.get('/api/guilds/<guild_id>')
 def get_guild_detail(guild_id: str):
     user: WebKeyStatus = g.user
-    with database:
+    with database.read():
         guild_ids = database.get_all_user_servers(user.id)
     if int(guild_id) not in guild_ids:
         return "Current user is not a member", 403
@@ -101,7 +104,7 @@ def get_guild_detail(guild_id: str):
 @bp.post('/api/playUrl')
 def play_song():
     user: WebKeyStatus = g.user
-    with database:
+    with database.read():
         disc_id = database.cur.execute(
             """
             SELECT discord_id FROM users
@@ -111,10 +114,18 @@ def play_song():
 
     body = PlaySongModel(**request.get_json())
     server = global_state.guild_server_map.get(body.guild_id)
-    disc_usr: Member = discord.utils.get(server.disc_guild. members, id=int(disc_id))
-    voice_channel: VoiceChannel = discord.utils.get(server.disc_guild.voice_channels, id=body.voice_channel_id)
-
-    if None in (disc_usr, voice_channel, server):
+    if server is None:
+        return "Incorrect guild or voice channel id", 400
+    # Looked up by id, the member may not be cached and has to be fetched by the bot's event loop
+    member_lookup = asyncio.run_coroutine_threadsafe(server.get_member(int(disc_id)), global_state.discord_client.loop)
+    try:
+        disc_usr: Optional[Member] = member_lookup.result(timeout=MEMBER_LOOKUP_TIMEOUT)
+    except FutureTimeoutError:
+        member_lookup.cancel()
+        return "Discord didn't answer in time, try again later", 504
+    voice_channel: VoiceChannel = server.disc_guild.get_channel(body.voice_channel_id)
+
+    if disc_usr is None or not isinstance(voice_channel, VoiceChannel):
         return "Incorrect guild or voice channel id", 400
 
     # Launch coroutine so that the api call is non-blocking
@@ -134,23 +145,25 @@ def play_song():
 @bp.get('/api/queue/<guild_id>')
 def get_queue(guild_id: str):
     user: WebKeyStatus = g.user
-    with database:
+    with database.read():
         guild_ids = database.get_all_user_servers(user.id)
     if int(guild_id) not in guild_ids:
         return "Current user is not a member", 403
 
     srv = global_state.guild_server_map[int(guild_id)]
+    songs, current_index = srv.music_player.queue.snapshot()
     return {
-        "current_index": srv.music_player.current_index,
+        "current_index": current_index,
         "queue": [
             {
-                "song_details": utils.get_function_default_args(x.source_func),
+                "song_details": x.track.to_dict(),
                 "requester": {
                     "name": x.requester.name,
                     "id": x.requester.id
                 },
                 "time_played": x.time_played.isoformat() if x.time_played is not None else None,
-                "time_requested": x.time_requested.isoformat()
-            } for x in srv.music_player.queue
+                "time_requested": x.time_requested.isoformat(),
+                "eta": srv.music_player.eta(i - current_index) if i > current_index else None
+            } for i, x in enumerate(songs)
         ]
     }
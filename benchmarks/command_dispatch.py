@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of command dispatch, messages per second for chat and command traffic
+Compares the shared CommandDispatcher with trying every command's regex in order
+Run from the project root: python -m benchmarks.command_dispatch
+"""
+import re
+import time
+from typing import Callable, Optional
+
+from bot.discord_app import default_dispatcher
+from bot.discord_server_commands import Command
+
+CHAT_MESSAGES = [
+    "hey, is anyone up for a game tonight?",
+    "lol",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ check this out",
+    "I'll be back in 5 minutes, don't start without me",
+    "p sure that's not how it works",
+    "+1 to that",
+]
+COMMAND_MESSAGES = [
+    "+p never gonna give you up",
+    "+play https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "+skip",
+    "+q",
+    "+seek 1:30",
+    "+top server 30d",
+]
+
+
+def linear_match(commands: list[Command], content: str) -> Optional[tuple[Command, re.Match]]:
+    for c in commands:
+        match = re.fullmatch(c.regex, content)
+        if match:
+            return c, match
+    return None
+
+
+def messages_per_second(match: Callable[[str], object], messages: list[str], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for m in messages:
+            match(m)
+    return rounds * len(messages) / (time.perf_counter() - start)
+
+
+def main(rounds: int = 20000):
+    commands = list(default_dispatcher.commands)
+    for m in CHAT_MESSAGES + COMMAND_MESSAGES:
+        linear, routed = linear_match(commands, m), default_dispatcher.match(m)
+        assert (linear and linear[0]) is (routed and routed[0]), f"Dispatch differs for \"{m}\""
+
+    for name, messages in (("chat", CHAT_MESSAGES), ("commands", COMMAND_MESSAGES)):
+        linear = messages_per_second(lambda m: linear_match(commands, m), messages, rounds)
+        routed = messages_per_second(default_dispatcher.match, messages, rounds)
+        print(f"{name:>8}: linear {linear:>12,.0f} msg/s | dispatcher {routed:>12,.0f} msg/s | {routed / linear:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Memory taken by cached guild members, with every member cached and with only the recently active ones
+Members are built from gateway-like payloads, the same way discord.py fills its cache
+Run from the project root: python -m benchmarks.member_cache
+"""
+import gc
+import tracemalloc
+
+import discord
+from discord.guild import Guild
+from discord.member import Member
+from discord.state import ConnectionState
+
+from config import config
+
+
+def member_payload(i: int) -> dict:
+    return {
+        'user': {'id': str(10**17 + i), 'username': f'user{i}', 'discriminator': '0000', 'avatar': 'a' * 32, 'global_name': None},
+        'roles': [str(10**17 + 1), str(10**17 + 2)],
+        'joined_at': '2021-01-01T00:00:00+00:00',
+        'nick': None,
+        'deaf': False,
+        'mute': False,
+        'flags': 0
+    }
+
+
+def cached_members_size(amount: int) -> int:
+    """
+    Bytes allocated by a guild caching amount members
+    """
+    state = ConnectionState(
+        dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+        intents=discord.Intents.all(), member_cache_flags=discord.MemberCacheFlags.all()
+    )
+    guild = Guild(
+        data={'id': '1', 'name': 'guild', 'owner_id': '2', 'roles': [], 'emojis': [], 'stickers': [], 'features': [], 'member_count': amount},
+        state=state
+    )
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(amount):
+        guild._add_member(Member(data=member_payload(i), guild=guild, state=state))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+
+def main(members: int = 10000):
+    recent = min(config.discord.recent_members, members)
+    for name, amount in (("all", members), ("voice", recent)):
+        size = cached_members_size(amount)
+        print(f"{name:>6}: {amount:>6} members cached, {size / 1024 / 1024:6.2f} MB, {size / max(amount, 1):,.0f} B per member")
+
+
+if __name__ == '__main__':
+    main()
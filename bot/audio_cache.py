@@ -0,0 +1,120 @@
+"""
+Bounded on-disk cache of the most played songs, downloaded in the background as opus
+"""
+import asyncio
+import os
+import time
+from typing import Optional, Iterable
+
+import global_state
+from bot.yt_extractor import extractor
+from config import config
+from database.async_db import async_database
+
+
+class CachedTrack:
+    """
+    POD-like class describing a downloaded song
+    """
+    def __init__(self, video_id: str, path: str, size: int):
+        self.video_id = video_id
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.last_access: float = time.time()
+
+
+class AudioCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: dict[str, CachedTrack] = {}
+        self.failed: set[str] = set()  # Videos that couldn't be downloaded, not retried until restart
+        if self.is_enabled():
+            self.load_directory()
+
+    def is_enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def total_size(self) -> int:
+        return sum(e.size for e in self.entries.values())
+
+    def load_directory(self):
+        """
+        Picks up songs downloaded by previous runs, leftovers of interrupted downloads get removed
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if f.endswith(('.part', '.ytdl')):
+                os.remove(path)
+                continue
+            video_id = f.split('.')[0]
+            self.entries[video_id] = CachedTrack(video_id, path, os.path.getsize(path))
+        self.evict()
+
+    def lookup(self, video_id: str) -> Optional[str]:
+        """
+        Returns the path of a downloaded song and records the access, None if not cached
+        """
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return None
+        if not os.path.isfile(entry.path):
+            del self.entries[video_id]
+            return None
+        entry.hits += 1
+        entry.last_access = time.time()
+        return entry.path
+
+    def evict(self, protected: Iterable[str] = ()):
+        """
+        Removes the least frequently played songs, least recently played first on ties, until under the size cap
+        """
+        protected = set(protected)
+        total = self.total_size()
+        candidates = sorted(
+            (e for e in self.entries.values() if e.video_id not in protected),
+            key=lambda e: (e.hits, e.last_access)
+        )
+        for e in candidates:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(e.path)  # A song still playing keeps its open file on posix systems
+            except OSError as exc:
+                print(f"Error: Couldn't remove cached song {e.path}. Details: {exc}")
+                continue
+            total -= e.size
+            del self.entries[e.video_id]
+
+    async def warm(self, video_ids: list[str]):
+        """
+        Downloads the songs that aren't cached yet, in order of priority
+        """
+        for i, video_id in enumerate(video_ids):
+            if video_id in self.entries or video_id in self.failed:
+                continue
+            try:
+                info = await extractor.download(video_id)
+                path = info['requested_downloads'][0]['filepath']
+            except Exception as exc:
+                print(f"Error: Couldn't download \"{video_id}\" to the audio cache. Details: {exc}")
+                self.failed.add(video_id)
+                continue
+            self.entries[video_id] = CachedTrack(video_id, path, os.path.getsize(path))
+            self.evict(protected=video_ids[:i])
+            if video_id not in self.entries:
+                break  # Cache is full of songs with higher priority
+        print(f"Info: Audio cache holds {len(self.entries)} songs, {self.total_size() // (1024 * 1024)} MB")
+
+    async def refresh_coro(self, interval: int, amount: int):
+        while True:
+            try:
+                await self.warm(await async_database.get_hot_video_ids(list(global_state.guild_server_map.keys()), amount))
+            except Exception as exc:
+                print(f"Error: Audio cache refresh failed. Details: {exc}")
+            await asyncio.sleep(interval)
+
+
+audio_cache = AudioCache(config.music.audio_cache_dir, config.music.audio_cache_max_mb * 1024 * 1024)
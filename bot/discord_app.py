@@ -1,13 +1,17 @@
+import asyncio
 from datetime import datetime
+from typing import Optional
 
 import bot.discord_default_global_commands as discord_default_global_commands
 import bot.discord_default_music_commands as discord_default_music_commands
 from config import config
-from discord import Client, Intents, Message, Guild, Member, VoiceState, RawMemberRemoveEvent
+from discord import Client, Intents, Message, Guild, Member, VoiceState, RawMemberRemoveEvent, MemberCacheFlags
 
 import global_state
-from database.db_controller import database
+from database.async_db import async_database
+from bot.audio_cache import audio_cache
 from bot.discord_server import Server
+from bot.discord_server_commands import CommandDispatcher, allow_commands, reset_allowed_commands
 from bot.forwarders import forward_message_to_server, forward_voice_state_to_server
 
 
@@ -20,15 +24,13 @@ async def event_setup(client: Client):
 
     @client.event
     async def on_member_join(member: Member):
-        with database:
-            database.register_users([(member.id, member.name)])
-            database.register_memberships(member.guild.id, [member.id])
+        if config.discord.member_cache == "all":  # Otherwise registered on their first command
+            await async_database.register_member(member.guild.id, member.id, member.name)
         print(f"Info: {member.name}#{member.discriminator} joined guild \'{member.guild.name}\'")
 
     @client.event
     async def on_raw_member_remove(payload: RawMemberRemoveEvent):
-        with database:
-            database.remove_membership(payload.guild_id, payload.user.id)
+        await async_database.remove_membership(payload.guild_id, payload.user.id)
         print(f"Info: {payload.user.name}#{payload.user.discriminator} left guild \'{global_state.guild_server_map[payload.guild_id].disc_guild.name}\'")
 
     # @client.event
@@ -59,22 +61,36 @@ async def setup():
     intent.reactions = True
 
     # Declare reference to client
-    main_client = Client(intents=intent)
+    if config.discord.member_cache == "voice":
+        # Guilds aren't chunked, members show up as they join voice channels or run commands
+        member_cache_flags = MemberCacheFlags.none()
+        member_cache_flags.voice = True
+        main_client = Client(intents=intent, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=False)
+    else:
+        main_client = Client(intents=intent)
     global_state.discord_client = main_client
 
     await event_setup(main_client)
+    audio_cache_task: Optional[asyncio.Task] = None
+    membership_sync_task: Optional[asyncio.Task] = None
 
     # Startup event
     @main_client.event
     async def on_ready():
+        nonlocal audio_cache_task, membership_sync_task
         global_state.start_time = datetime.now()
 
         for g in main_client.guilds:
-            await register_server(g)
+            await add_server(g)
 
-        for s in global_state.guild_server_map.values():
-            s.register_commands(discord_default_global_commands.get_global_defaults(prefix='+'))
-            s.register_commands(discord_default_music_commands.get_music_defaults(prefix='+'))
+        # Servers already answer commands, their members are brought up to date in the background
+        if membership_sync_task is None or membership_sync_task.done():
+            membership_sync_task = main_client.loop.create_task(sync_memberships(main_client.guilds))
+
+        if audio_cache.is_enabled() and audio_cache_task is None:
+            audio_cache_task = main_client.loop.create_task(
+                audio_cache.refresh_coro(config.music.audio_cache_refresh, config.music.audio_cache_top_n)
+            )
 
         print("Info: Discord bot initialized")
 
@@ -82,19 +98,52 @@ async def setup():
 
 
 # -------------- Internal guild map update --------------
-async def register_server(guild: Guild):
+# Compiled once, guilds only get their own dispatcher when they register commands of their own
+default_dispatcher = CommandDispatcher(
+    discord_default_global_commands.get_global_defaults(prefix='+')
+    + discord_default_music_commands.get_music_defaults(prefix='+')
+)
+
+
+async def add_server(guild: Guild):
     async with global_state.guild_server_map_lock:
-        global_state.guild_server_map[guild.id] = Server(guild)
+        allow_commands(default_dispatcher)
+        global_state.guild_server_map = {**global_state.guild_server_map, guild.id: Server(guild, default_dispatcher)}
         global_state.server_membership_count += 1
-    with database:
-        database.register_users([(x.id, x.name) for x in guild.members])
-        database.register_server(guild.id, guild.name, guild.owner.id)
-        database.register_memberships(guild.id, [m.id for m in guild.members])
     print(f"Info: Bot joined guild \"{guild.name}\"")
 
 
+async def register_server(guild: Guild):
+    await add_server(guild)
+    await sync_memberships([guild])
+
+
+async def sync_memberships(guilds: list[Guild]):
+    """
+    Writes the difference between the member lists of guilds and the database, a chunk of guilds per transaction
+    The event loop only builds each chunk's member lists, the database work runs on its own thread
+    """
+    chunk_size = max(config.database.membership_sync_chunk, 1)
+    complete = config.discord.member_cache == "all"  # Departed members can only be told apart with every member cached
+    added, removed = 0, 0
+    for i in range(0, len(guilds), chunk_size):
+        chunk = [
+            (g.id, g.name, g.owner_id, [(m.id, m.name) for m in g.members])
+            for g in guilds[i:i + chunk_size]
+        ]
+        try:
+            c_added, c_removed = await async_database.sync_servers(chunk, prune=complete)
+        except Exception as exc:
+            print(f"Error: Couldn't sync the members of {len(chunk)} guilds. Details: {exc}")
+            continue
+        added, removed = added + c_added, removed + c_removed
+        await asyncio.sleep(0)
+    print(f"Info: Synced members of {len(guilds)} guilds, {added} memberships added and {removed} removed")
+
+
 async def remove_server(guild: Guild):
     async with global_state.guild_server_map_lock:
-        global_state.guild_server_map.pop(guild.id)
+        global_state.guild_server_map = {k: v for k, v in global_state.guild_server_map.items() if k != guild.id}
+        reset_allowed_commands(s.dispatcher for s in global_state.guild_server_map.values())
         global_state.server_membership_count -= 1
     print(f"Info: Bot was removed from guild \"{guild.name}\"")
@@ -6,16 +6,19 @@ import global_state
 from config import config
 from bot.discord_server import Server
 from bot.discord_server_commands import Command
+from bot.song_generators import fanout
 
 
 async def info_command(msg: Message, srv: Server):
+    fanout_stats = fanout.stats()
     try:
         await msg.channel.send(
             content="\n".join((
                 "```",
                 f"Mamanogra v0.2 - {config.discord.info_message}",
                 "Made by Smug Twingo",
-                f"Uptime: {str(datetime.now() - global_state.start_time).split('.')[0]}"
+                f"Uptime: {str(datetime.now() - global_state.start_time).split('.')[0]}",
+                f"Shared streams: {fanout_stats['active_pipelines']} active, {fanout_stats['streams_deduplicated']} deduplicated",
                 "```"
             ))
         )
@@ -36,7 +39,7 @@ async def webui_command(msg: Message, srv: Server):
 
 def get_global_defaults(prefix: str):
     commands = [
-        (fr"\{prefix}(?:info$|i$)", info_command),
-        (fr"\{prefix}(?:w$|webui$)", webui_command)
+        (fr"\{prefix}(?:info$|i$)", info_command, ('info', 'i')),
+        (fr"\{prefix}(?:w$|webui$)", webui_command, ('w', 'webui'))
     ]
-    return [Command(*x) for x in commands]
+    return [Command(regex, delegate, [prefix + k for k in keywords]) for regex, delegate, keywords in commands]
@@ -1,15 +1,19 @@
-import random
+import asyncio
 from typing import Optional, Literal
 
 from discord import Message
-from yt_dlp import YoutubeDL
 
-import utils
-from database.db_controller import database
+import global_state
+from config import config
+from database.async_db import async_database
 
 from bot.discord_server import Server
 from bot.discord_server_commands import Command
-from bot.song_generators import generate_youtube_song, generate_url_song
+from bot.music_player import QUEUE_VIEW_UPCOMING
+from bot.song_generators import generate_youtube_song, generate_url_song, generate_lazy_youtube_song
+from bot.yt_extractor import extractor
+
+DISCORD_MESSAGE_LIMIT = 2000  # Characters
 
 
 async def play_url_command(msg: Message, srv: Server, yt_id: str = None):
@@ -24,32 +28,80 @@ async def play_query_command(msg: Message, srv: Server, query: str = None):
         await srv.music_player.play(msg.author, await generate_youtube_song(f"ytsearch:{queries[0]}"))
     else:
         print(f"Info: {msg.author.name}#{msg.author.discriminator} queuing multi query \"{query}\"")
-        for q in queries:
-            await srv.music_player.play(msg.author, await generate_youtube_song(f"ytsearch:{q}"))
+        semaphore = asyncio.Semaphore(config.music.query_concurrency)
+
+        async def resolve_query(q: str):
+            async with semaphore:
+                return await generate_youtube_song(f"ytsearch:{q}")
+
+        # Searches run concurrently but get queued in the order they were typed
+        tasks = [asyncio.ensure_future(resolve_query(q)) for q in queries]
+        try:
+            for q, task in zip(queries, tasks):
+                try:
+                    song = await task
+                except Exception as exc:
+                    print(f"Error: Couldn't resolve query \"{q}\" requested by {msg.author.name}#{msg.author.discriminator}. Details: {exc}")
+                    await msg.channel.send(f"```\nCouldn't find anything for \"{q.strip()}\"\n```")
+                    continue
+                await srv.music_player.play(msg.author, song)
+        finally:
+            for task in tasks:
+                task.cancel()
 
 
 async def play_playlist_command(msg: Message, srv: Server, yt_id: str = None):
-    yt_query = YoutubeDL({
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'extract_flat': True,
-        'playlist_items': '1:10'
-    }).extract_info(
-        msg.content.split(' ')[-1],
-        download=False
+    playlist_url = msg.content.split(' ')[-1]
+    page_size = config.music.playlist_page_size
+    yt_query = await extractor.extract(
+        playlist_url,
+        'flat_playlist',
+        playlist_items=f'1:{page_size}'
     )
 
     if yt_query['_type'] != 'playlist':
-        print(f"Error: yt-dlp extraction using \"{msg.content.split(' ')[-1]}\" was not of playlist type")
+        print(f"Error: yt-dlp extraction using \"{playlist_url}\" was not of playlist type")
         await msg.channel.send("```\nCannot access this playlist!\n```")
         return
 
-    print(f"Info: Queuing playlist \"{yt_query['title']}\" requested by {msg.author.name}#{msg.author.discriminator} using \"{msg.content.split(' ')[-1]}\"")
-    for e in yt_query['entries']:
-        await srv.music_player.play(
-            msg.author,
-            await generate_youtube_song(e['id'])
+    print(f"Info: Queuing playlist \"{yt_query['title']}\" requested by {msg.author.name}#{msg.author.discriminator} using \"{playlist_url}\"")
+    # Entries are queued straight from the flat metadata, each one gets resolved right before it plays
+    songs = [generate_lazy_youtube_song(e) for e in yt_query['entries'] if e.get('id') is not None]
+    if len(songs) == 0:
+        return
+    await srv.music_player.play(msg.author, songs[0])
+    await srv.music_player.enqueue(songs[1:], msg.author)
+
+    if len(yt_query['entries']) == page_size:
+        global_state.discord_client.loop.create_task(
+            queue_playlist_pages(srv, msg, playlist_url, page_size + 1)
+        )
+
+
+async def queue_playlist_pages(srv: Server, msg: Message, playlist_url: str, start: int):
+    """
+    Keeps queuing pages of a playlist in the background until it runs out or reaches the size limit
+    """
+    page_size, max_items = config.music.playlist_page_size, config.music.playlist_max_items
+    while start <= max_items:
+        end = min(start + page_size - 1, max_items)
+        try:
+            yt_query = await extractor.extract(playlist_url, 'flat_playlist', playlist_items=f'{start}:{end}')
+        except Exception as exc:
+            print(f"Error: Couldn't fetch entries {start}:{end} of playlist \"{playlist_url}\". Details: {exc}")
+            return
+        entries = yt_query.get('entries') or []
+        # Stop if the bot left in the meantime
+        if srv.music_player.voice_client is None:
+            return
+        await srv.music_player.enqueue(
+            [generate_lazy_youtube_song(e) for e in entries if e.get('id') is not None],
+            msg.author
         )
+        if len(entries) < end - start + 1:
+            return
+        start = end + 1
+    print(f"Info: Playlist \"{playlist_url}\" was cut at {max_items} songs")
 
 
 async def skip_command(msg: Message, srv: Server, n_times_str: str = '1'):
@@ -58,11 +110,13 @@ async def skip_command(msg: Message, srv: Server, n_times_str: str = '1'):
         if srv.music_player.voice_client is None:
             return
     print(f"Info: {msg.author.name}#{msg.author.discriminator} skipped {n_times} song(s) in {srv.disc_guild.name}")
-    if 0 <= srv.music_player.current_index + n_times < len(srv.music_player.queue) and srv.music_player.voice_client.is_playing():
+    if srv.music_player.queue.get(n_times) is not None and srv.music_player.voice_client.is_playing():
         async with srv.music_player.voice_client_lock:
-            srv.music_player.current_index += n_times - 1
+            srv.music_player.queue.advance(n_times - 1)
+            if n_times != 1:
+                srv.music_player.invalidate_prefetch()  # Skipping a single song lands on the prefetched one
     else:
-        if srv.music_player.current_index == len(srv.music_player.queue) - 1 and n_times == 1 and srv.music_player.voice_client.is_playing():
+        if len(srv.music_player.queue) == 1 and n_times == 1 and srv.music_player.voice_client.is_playing():
             pass  # If trying to skip last song, allow to go out of bounds
         else:
             return
@@ -71,52 +125,66 @@ async def skip_command(msg: Message, srv: Server, n_times_str: str = '1'):
 
 
 async def queue_command(msg: Message, srv: Server):
-    await msg.channel.send(
-        "".join([
+    # Discord refuses longer messages, show fewer upcoming songs until the queue fits
+    for upcoming in range(QUEUE_VIEW_UPCOMING, -1, -1):
+        text = "".join([
             "```\n",
             "----Queue----\n\n",
-            "\n".join(srv.music_player.print_queue()),
+            "\n".join(srv.music_player.print_queue(upcoming=upcoming)),
             "\n```"
         ])
-    )
+        if len(text) <= DISCORD_MESSAGE_LIMIT:
+            break
+    await msg.channel.send(text)
 
 
 async def seek_command(msg: Message, srv: Server, timestamp: str):
-    split_stamp = [int(x) for x in timestamp.split(':')]
-    if not all(x < 60 for x in split_stamp):
-        return
-    if len(split_stamp) == 2:
-        m, s = split_stamp
-        sec_stamp = m * 60 + s
+    # Relative seeks look like +30 or -10
+    if timestamp[0] in '+-':
+        position = srv.music_player.current_position()
+        if position is None:
+            return
+        sec_stamp = position + int(timestamp)
     else:
-        h, m, s = split_stamp
-        sec_stamp = h * 3600 + m * 60 + s
-
-    # Modify current function's default args to include seeking
-    cur_song_func = srv.music_player.queue[srv.music_player.current_index].source_func
-    song_args = utils.get_function_default_args(cur_song_func)
-    if 'seek' not in song_args:
-        return
-    song_args['seek'] = sec_stamp
-    async with srv.music_player.voice_client_lock:
-        cur_song_func.__defaults__ = tuple(song_args.values())
-        srv.music_player.seek_flag = True
-        srv.music_player.current_index -= 1
+        split_stamp = [int(x) for x in timestamp.split(':')]
+        if not all(x < 60 for x in split_stamp):
+            return
+        if len(split_stamp) == 2:
+            m, s = split_stamp
+            sec_stamp = m * 60 + s
+        else:
+            h, m, s = split_stamp
+            sec_stamp = h * 3600 + m * 60 + s
 
-    print(f"Info: {msg.author.name}#{msg.author.discriminator} seeked to {timestamp}")
-    srv.music_player.voice_client.stop()
+    if await srv.music_player.seek(sec_stamp):
+        print(f"Info: {msg.author.name}#{msg.author.discriminator} seeked to {timestamp}")
 
 
 async def shuffle_command(msg: Message, srv: Server):
-    cur_idx = srv.music_player.current_index
-    if cur_idx < len(srv.music_player.queue):
+    if srv.music_player.queue.current() is not None:
         async with srv.music_player.voice_client_lock:
-            queue_slice = srv.music_player.queue[cur_idx + 1:]
-            random.shuffle(queue_slice)
-            srv.music_player.queue[cur_idx + 1:] = queue_slice
+            srv.music_player.queue.shuffle()
+            srv.music_player.schedule_prefetch()  # Next song most likely changed
         print(f"Info: {msg.author.name}#{msg.author.discriminator} shuffled the queue in {srv.disc_guild.name}")
 
 
+async def move_command(msg: Message, srv: Server, position: str, new_position: str):
+    async with srv.music_player.voice_client_lock:
+        if not srv.music_player.queue.move(int(position), int(new_position)):
+            return
+        srv.music_player.schedule_prefetch()
+    print(f"Info: {msg.author.name}#{msg.author.discriminator} moved song {position} to {new_position} in {srv.disc_guild.name}")
+
+
+async def remove_command(msg: Message, srv: Server, position: str):
+    async with srv.music_player.voice_client_lock:
+        song = srv.music_player.queue.remove(int(position))
+        if song is None:
+            return
+        srv.music_player.schedule_prefetch()
+    print(f"Info: {msg.author.name}#{msg.author.discriminator} removed \"{song.track.title}\" from the queue in {srv.disc_guild.name}")
+
+
 async def play_file_command(msg: Message, srv: Server, url: Optional[str] = None):
     i_url = url
     if len(msg.attachments) > 0:
@@ -128,20 +196,25 @@ async def play_file_command(msg: Message, srv: Server, url: Optional[str] = None
     await srv.music_player.play(msg.author, await generate_url_song(i_url))
 
 
-async def top_command(msg: Message, srv: Server, q_type: Optional[Literal['global', 'server']] = None):
-    with database:
-        if q_type is None:
-            scope = 'Local'
-            author = msg.author.display_name
-            top_songs = [x for x in database.get_top_songs_local(msg.author.id, msg.guild.id)]
-        elif q_type == 'global':
-            scope = 'Global'
-            author = msg.author.display_name
-            top_songs = [x for x in database.get_top_songs_global(msg.author.id)]
-        elif q_type == 'server':
-            scope = 'Server'
-            author = msg.guild.name
-            top_songs = [x for x in database.get_top_songs_server(msg.guild.id)]
+async def top_command(msg: Message, srv: Server, *options: str):
+    # Options are an optional scope (global, server) followed by an optional window in days
+    q_type: Optional[Literal['global', 'server']] = next((o for o in options if o in ('global', 'server')), None)
+    days = next((int(o) for o in options if o.isdigit()), None)
+
+    if q_type is None:
+        scope = 'Local'
+        author = msg.author.display_name
+        top_songs = await async_database.get_top_songs_local(msg.author.id, msg.guild.id, days=days)
+    elif q_type == 'global':
+        scope = 'Global'
+        author = msg.author.display_name
+        top_songs = await async_database.get_top_songs_global(msg.author.id, days=days)
+    elif q_type == 'server':
+        scope = 'Server'
+        author = msg.guild.name
+        top_songs = await async_database.get_top_songs_server(msg.guild.id, days=days)
+    if days is not None:
+        scope += f' {days} day'
 
     message = f'\n**{scope} top for {author}**\n```\n'
     i = 0
@@ -154,14 +227,16 @@ async def top_command(msg: Message, srv: Server, q_type: Optional[Literal['globa
 
 def get_music_defaults(prefix: str):
     commands = [
-        (fr"\{prefix}(?:pe |play embed |pe$|play embed$)(.+\.(?:mp3$|ogg$|wav$|mp4$))?", play_file_command),
-        (fr"\{prefix}(?:p |play )https:\/\/(?:(?:www\.youtube\.com\/.*?watch\?v=([\w\d\-\_]*).*)|(?:youtu\.be\/([\w\d\-\_]+)))", play_url_command),
-        (fr"\{prefix}(?:p |play )([^|]+(?!\| \|)(?:\|(?:[^|]+))*)", play_query_command),
-        (fr"\{prefix}(?:pl |playlist )https:\/\/www\.youtube\.com\/.*?list=([\w\d]*).*", play_playlist_command),
-        (fr"\{prefix}(?:s |skip |s$|skip$)(?:(?!0)(?!-0)(-?\d+))?", skip_command),
-        (fr"\{prefix}(?:sh$|shuffle$)", shuffle_command),
-        (fr"\{prefix}(?:q$|queue$)", queue_command),
-        (fr"\{prefix}seek (\d?\d:\d\d:\d\d$|\d?\d:\d\d$)", seek_command),
-        (fr"\{prefix}top(?:$| (global$|server$))", top_command)
+        (fr"\{prefix}(?:pe |play embed |pe$|play embed$)(.+\.(?:mp3$|ogg$|wav$|mp4$))?", play_file_command, ('pe', 'play')),
+        (fr"\{prefix}(?:p |play )https:\/\/(?:(?:www\.youtube\.com\/.*?watch\?v=([\w\d\-\_]*).*)|(?:youtu\.be\/([\w\d\-\_]+)))", play_url_command, ('p', 'play')),
+        (fr"\{prefix}(?:p |play )([^|]+(?!\| \|)(?:\|(?:[^|]+))*)", play_query_command, ('p', 'play')),
+        (fr"\{prefix}(?:pl |playlist )https:\/\/www\.youtube\.com\/.*?list=([\w\d]*).*", play_playlist_command, ('pl', 'playlist')),
+        (fr"\{prefix}(?:s |skip |s$|skip$)(?:(?!0)(?!-0)(-?\d+))?", skip_command, ('s', 'skip')),
+        (fr"\{prefix}(?:sh$|shuffle$)", shuffle_command, ('sh', 'shuffle')),
+        (fr"\{prefix}(?:q$|queue$)", queue_command, ('q', 'queue')),
+        (fr"\{prefix}(?:mv |move )([1-9]\d*) ([1-9]\d*)$", move_command, ('mv', 'move')),
+        (fr"\{prefix}(?:rm |remove )([1-9]\d*)$", remove_command, ('rm', 'remove')),
+        (fr"\{prefix}seek (?:(\d?\d:\d\d:\d\d$|\d?\d:\d\d$)|([+-]\d+)s?$)", seek_command, ('seek',)),
+        (fr"\{prefix}top(?: (global|server))?(?: ([1-9]\d{{0,3}})d)?$", top_command, ('top',))
     ]
-    return [Command(*x) for x in commands]
+    return [Command(regex, delegate, [prefix + k for k in keywords]) for regex, delegate, keywords in commands]
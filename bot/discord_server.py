@@ -1,14 +1,15 @@
 import os
-import re
+from collections import OrderedDict
 from datetime import datetime
-from typing import Callable, Any, Awaitable, Iterable
+from typing import Callable, Any, Awaitable, Iterable, Optional
 
-from discord import Guild, Message, VoiceState, User
+from discord import Guild, Message, VoiceState, User, Member, NotFound
 
 from config import config
-from database.db_controller import database
-from bot.discord_server_commands import Command
-from bot.music_player import MusicPlayer
+from database.async_db import async_database
+from database.write_behind import telemetry_writer
+from bot.discord_server_commands import Command, CommandDispatcher, allow_commands
+from bot.music_player import MusicPlayer, PlayerState
 
 
 class Server:
@@ -16,68 +17,100 @@ class Server:
     Used to internally represent a discord guild
     Contains commands, music queue
     """
-    def __init__(self, guild: Guild):
+    def __init__(self, guild: Guild, dispatcher: CommandDispatcher = CommandDispatcher()):
         self.disc_guild = guild
-        self.commands: list[Command] = []  # Match command using regex, delegate argument parsing to function
+        self.dispatcher = dispatcher  # Match command using regex, delegate argument parsing to function
         self.music_player = MusicPlayer(self.disc_guild)
+        self.recent_members: OrderedDict[int, Member] = OrderedDict()  # Only used when not every member is cached
 
     async def message_entrypoint(self, message: Message):
         try:
             # Match command regex and send to delegate, calls first match
             # Send matched groups as arguments to delegate
-            for c in self.commands:
-                match = re.fullmatch(c.regex, message.content)
-                if match:
-                    with database:
-                        database.log_command(message.content, message.author.id, self.disc_guild.id)
-                    await c.delegate(message, self, *[x for x in match.groups() if x is not None])
-                    return
+            routed = self.dispatcher.match(message.content)
+            if routed is None:
+                return
+            c, match = routed
+            if config.discord.member_cache != "all" and self.remember_member(message.author):
+                await async_database.register_member(self.disc_guild.id, message.author.id, message.author.name)
+            telemetry_writer.log_command(message.content, message.author.id, self.disc_guild.id)
+            await c.delegate(message, self, *[x for x in match.groups() if x is not None])
         except Exception as exc:
             self.message_error_handler(message, exc)
 
     async def voice_state_entrypoint(self, before: VoiceState, after: VoiceState):
-        if before.channel is not None and after.channel is None and not self.music_player.disconnect_flag:
+        # The player's own disconnects aren't in the connected state anymore by the time this arrives
+        if before.channel is not None and after.channel is None and self.music_player.state is PlayerState.CONNECTED:
             print(f"Info: Bot forcefully disconnected from {before.channel.name}")
-            self.music_player.force_disconnect_flag = True
-            await self.music_player.voice_client.disconnect(force=True)
-            self.music_player.voice_client = None
-        if self.music_player.disconnect_flag:
-            self.music_player.disconnect_flag = False
+            await self.music_player.disconnect(finish_queue=False)
+
+    def remember_member(self, member: Member) -> bool:
+        """
+        Keeps member in the bounded recently active cache, returns whether it wasn't in it
+        """
+        new = member.id not in self.recent_members
+        self.recent_members[member.id] = member
+        self.recent_members.move_to_end(member.id)
+        while len(self.recent_members) > config.discord.recent_members:
+            self.recent_members.popitem(last=False)
+        return new
+
+    async def get_member(self, user_id: int) -> Optional[Member]:
+        """
+        Looks a member up by id in the caches, asks discord if it isn't cached
+        """
+        member = self.disc_guild.get_member(user_id) or self.recent_members.get(user_id)
+        if member is not None:
+            return member
+        try:
+            member = await self.disc_guild.fetch_member(user_id)
+        except NotFound:
+            return None
+        if config.discord.member_cache != "all":
+            self.remember_member(member)
+        return member
 
     def register_commands(self, command: Iterable[Command]):
-        self.commands.extend(command)
+        self.dispatcher = self.dispatcher.extended(command)
+        allow_commands(self.dispatcher)
+
+    def override_commands(self, command: Iterable[Command]):
+        """
+        Registers commands for this guild only, tried before the shared ones
+        """
+        self.dispatcher = self.dispatcher.overridden(command)
+        allow_commands(self.dispatcher)
 
     async def generate_web_key(self, user: User):
         key = "".join(hex(x).removeprefix('0x') for x in os.urandom(128))
         token = "".join(hex(x).removeprefix('0x') for x in os.urandom(16))
-        with database:
-            status = database.get_web_keys_status(user.id)
-            # If no key or token, generate a new one
-            if status is None:
-                database.register_new_web_key(user.id, key, token)
-                await user.send(f"Your URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
-                print(f"Info: Generated token ({token}) and key for {user.name}#{user.discriminator} in {self.disc_guild.name}")
-                return
-            # If token but no key, resend
-            if status.request_token_expiration_date > datetime.now() and not status.validated:
-                await user.send(f"Resending URL:\n{config.server.domain}:{config.server.port}/keygen/{status.request_token}\nExpires soon")
-                print(f"Info: Resent token url for {user.name}#{user.discriminator} in {self.disc_guild.name}")
-                return
-            # If token expired and still no key, regenerate
-            if status.request_token_expiration_date < datetime.now() and not status.validated:
-                database.regenerate_token(status.id, token)
-                await user.send(f"Regenerating URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
-                print(f"Info: Regenerated token ({token}) for {user.name}#{user.discriminator} in {self.disc_guild.name}")
-                return
-            # Has key, regenerate
-            if status.key_expiration_date < datetime.now() or status.validated:
-                database.regenerate_key(status.id, key)
-                database.regenerate_token(status.id, token)
-                await user.send(f"Your URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
-                print(f"Info: Regenerated token ({token}) and key for {user.name}#{user.discriminator} in {self.disc_guild.name}")
-                return
+        # Database work is awaited to completion before any message goes out
+        status = await async_database.get_web_keys_status(user.id)
+        # If no key or token, generate a new one
+        if status is None:
+            await async_database.register_new_web_key(user.id, key, token)
+            await user.send(f"Your URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
+            print(f"Info: Generated token ({token}) and key for {user.name}#{user.discriminator} in {self.disc_guild.name}")
+            return
+        # If token but no key, resend
+        if status.request_token_expiration_date > datetime.now() and not status.validated:
+            await user.send(f"Resending URL:\n{config.server.domain}:{config.server.port}/keygen/{status.request_token}\nExpires soon")
+            print(f"Info: Resent token url for {user.name}#{user.discriminator} in {self.disc_guild.name}")
+            return
+        # If token expired and still no key, regenerate
+        if status.request_token_expiration_date < datetime.now() and not status.validated:
+            await async_database.regenerate_token(status.id, token)
+            await user.send(f"Regenerating URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
+            print(f"Info: Regenerated token ({token}) for {user.name}#{user.discriminator} in {self.disc_guild.name}")
+            return
+        # Has key, regenerate
+        if status.key_expiration_date < datetime.now() or status.validated:
+            await async_database.regenerate_key_and_token(status.id, key, token)
+            await user.send(f"Your URL:\n{config.server.domain}:{config.server.port}/keygen/{token}\nExpires in 5 minutes")
+            print(f"Info: Regenerated token ({token}) and key for {user.name}#{user.discriminator} in {self.disc_guild.name}")
+            return
 
 
-def register_command(server: Server, regex: str, delegate: Callable[[Message, Server], Awaitable[Any]]):
-    server.commands.append(Command(regex, delegate))
+def register_command(server: Server, regex: str, delegate: Callable[[Message, Server], Awaitable[Any]], keywords: Iterable[str] = ()):
+    server.register_commands([Command(regex, delegate, keywords)])
     return server  # Allow method chaining
@@ -1,5 +1,5 @@
 import re
-from typing import Any, Callable, Awaitable
+from typing import Any, Callable, Awaitable, Iterable, Optional
 
 from discord import Message
 
@@ -7,7 +7,75 @@ from discord import Message
 class Command:
     """
     POD-like class to hold data about a command
+    keywords are the first words (prefix included) of the messages the regex can match,
+    a command without keywords is tried against every message
     """
-    def __init__(self, regex: str, delegate: Callable[[Message, Any, ...], Awaitable[Any]]):
+    def __init__(self, regex: str, delegate: Callable[[Message, Any, ...], Awaitable[Any]], keywords: Iterable[str] = ()):
         self.regex: re.Pattern = re.compile(regex)
         self.delegate = delegate
+        self.keywords: tuple[str, ...] = tuple(keywords)
+
+
+class CommandDispatcher:
+    """
+    Finds the first command, in registration order, whose regex fully matches a message
+    Messages are routed by their first word so most of them never reach a regex. Dispatchers are immutable,
+    registering commands returns a new one so a single dispatcher can be shared by every guild
+    """
+    def __init__(self, commands: Iterable[Command] = ()):
+        self.commands: tuple[Command, ...] = tuple(commands)
+        self.fallback: list[Command] = [c for c in self.commands if len(c.keywords) == 0]
+        self.routes: dict[str, list[Command]] = {}
+        for c in self.commands:
+            for keyword in c.keywords:
+                self.routes.setdefault(keyword, [])
+        for keyword, route in self.routes.items():
+            route.extend(c for c in self.commands if keyword in c.keywords or len(c.keywords) == 0)
+        # Without fallback commands, a message can only match if it starts like one of the keywords
+        self.first_chars: Optional[frozenset[str]] = None if self.fallback else frozenset(k[0] for k in self.routes if k)
+
+    def match(self, content: str) -> Optional[tuple[Command, re.Match]]:
+        if self.first_chars is not None and content[:1] not in self.first_chars:
+            return None
+        for c in self.routes.get(content.partition(' ')[0], self.fallback):
+            match = c.regex.fullmatch(content)
+            if match:
+                return c, match
+        return None
+
+    def extended(self, commands: Iterable[Command]) -> 'CommandDispatcher':
+        """
+        New dispatcher trying commands after the ones of this dispatcher
+        """
+        return CommandDispatcher(self.commands + tuple(commands))
+
+    def overridden(self, commands: Iterable[Command]) -> 'CommandDispatcher':
+        """
+        New dispatcher trying commands before the ones of this dispatcher
+        """
+        return CommandDispatcher(tuple(commands) + self.commands)
+
+
+# First characters of the commands of every server's dispatcher, messages starting with anything else can't be commands.
+# None while a server has a command without keywords. Replaced rather than mutated, readers don't lock.
+command_first_chars: Optional[frozenset[str]] = frozenset()
+
+
+def allow_commands(dispatcher: CommandDispatcher):
+    """
+    Lets the messages the commands of dispatcher could match through the early filter, called when a server gets it
+    """
+    global command_first_chars
+    if command_first_chars is None or (dispatcher.first_chars is not None and dispatcher.first_chars <= command_first_chars):
+        return
+    command_first_chars = None if dispatcher.first_chars is None else command_first_chars | dispatcher.first_chars
+
+
+def reset_allowed_commands(dispatchers: Iterable[CommandDispatcher]):
+    """
+    Narrows the early filter down to the commands of dispatchers, the ones of the servers left
+    """
+    global command_first_chars
+    command_first_chars = frozenset()
+    for d in set(dispatchers):
+        allow_commands(d)
@@ -1,26 +1,33 @@
 from discord import Message, Member, VoiceState
 import global_state
+import bot.discord_server_commands as discord_server_commands
 from bot.discord_server import Server
 
 
+def is_possible_command(message: Message) -> bool:
+    """
+    Cheap checks on events the bot can never act on, done before looking the server up
+    """
+    if message.guild is None or message.author.bot:
+        return False  # possible place to handle direct messages
+    first_chars = discord_server_commands.command_first_chars
+    return first_chars is None or message.content[:1] in first_chars
+
+
 async def forward_message_to_server(message: Message):
-    async with global_state.guild_server_map_lock:
-        if global_state.guild_server_map.get(message.guild.id) is not None:
-            server: Server = global_state.guild_server_map[message.guild.id]
-        else:
-            # possible place to handle direct messages
-            return
+    if not is_possible_command(message):
+        return
+    server: Server = global_state.guild_server_map.get(message.guild.id)  # Lock free, the map is copy on write
+    if server is None:
+        return
     await server.message_entrypoint(message)
 
 
 async def forward_voice_state_to_server(member: Member, before: VoiceState, after: VoiceState):
-    async with global_state.guild_server_map_lock:
-        # Only forward to server if the bot was updated
-        if member == global_state.discord_client.user:
-            if global_state.guild_server_map.get(member.guild.id) is not None:
-                server: Server = global_state.guild_server_map[member.guild.id]
-            else:
-                return
-        else:
-            return
+    # Only forward to server if the bot was updated
+    if member.id != global_state.discord_client.user.id:
+        return
+    server: Server = global_state.guild_server_map.get(member.guild.id)
+    if server is None:
+        return
     await server.voice_state_entrypoint(before, after)
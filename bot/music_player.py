@@ -1,13 +1,20 @@
 import asyncio
 from datetime import datetime
 from enum import Enum
-from typing import Union, Callable, Optional
-from database.db_controller import database
+from typing import Union, Optional
+from database.write_behind import telemetry_writer, SongRecord
 
-from discord import FFmpegPCMAudio, Guild, User, Member, VoiceClient, ClientException, VoiceChannel
+from discord import AudioSource, Guild, User, Member, VoiceClient, ClientException, VoiceChannel
 
 import global_state
-import utils
+from bot.scheduler import scheduler
+from bot.song_queue import SongQueue
+from bot.track import Track, SourceKind
+from bot.yt_extractor import extractor
+from config import config
+
+QUEUE_VIEW_HISTORY = 2  # Played songs shown before the current one by print_queue
+QUEUE_VIEW_UPCOMING = 10  # Upcoming songs shown by print_queue, the rest are summed up in a single line
 
 
 class RepeatType(Enum):
@@ -16,17 +23,20 @@ class RepeatType(Enum):
     FOREVER = 2
 
 
+class PlayerState(Enum):
+    DISCONNECTED = 0
+    CONNECTED = 1
+    DISCONNECTING = 2  # Stopping playback must not advance the queue
+
+
 class Song:
     """
-    POD-like class to gather song data
-
-    source_func must have these arguments with a default value in order to provide data about the song:
-        - title: str
-        - duration: int <seconds>
-        - thumbnail: str <url to image>
+    POD-like class to gather the queue entry of a track
     """
-    def __init__(self, source_func: Callable[[], FFmpegPCMAudio], requester: Member):
-        self.source_func = source_func  # Replace by an interface to a class instead of function
+    __slots__ = ('track', 'requester', 'time_requested', 'time_played', 'repeat_type')
+
+    def __init__(self, track: Track, requester: Member):
+        self.track = track
         self.requester = requester
         self.time_requested: datetime = datetime.now()
         self.time_played: Union[datetime, None] = None
@@ -38,101 +48,234 @@ class MusicPlayer:
         self.guild: Guild = guild  # Get voice client instance from here
         self.voice_client: Union[VoiceClient, None] = None
         self.voice_client_lock: asyncio.Lock = asyncio.Lock()
-        self.queue: list[Song] = []
-        self.current_index: int = 0  # Represents current song queue index
+        self.play_lock: asyncio.Lock = asyncio.Lock()  # Held while a song's source is being built
+        self.queue: SongQueue = SongQueue(config.music.queue_history)
 
-        self.seek_flag = False
-        self.disconnect_flag = False
-        self.force_disconnect_flag = False
+        # Lookahead state for the song after the current one
+        self.prefetch_song: Optional[Song] = None
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.prefetched_source: Optional[AudioSource] = None
 
-        self.cleanup_task = global_state.discord_client.loop.create_task(
-            self.cleanup_coro(120)
-        )
+        self.state: PlayerState = PlayerState.DISCONNECTED
+        self.idle_key = ('idle_disconnect', guild.id)  # Deadline armed while connected
 
     # Returns a function with bound variables to serve as callback
     def finishing_callback(self):
-        def callback(error: Optional[Exception], last_song: Optional[Song] = self.queue[self.current_index] if self.current_index < len(self.queue) else None, player: MusicPlayer = self):
+        def callback(error: Optional[Exception], last_song: Optional[Song] = self.queue.current(), player: MusicPlayer = self):
             if error is not None:
                 print(f"Error: Exception received while playing a song. Details: {error}")
                 return
 
             # Remove any seeking left over
             if last_song is not None:
-                args = utils.get_function_default_args(last_song.source_func)
-                if not player.seek_flag and 'seek' in args:
-                    args['seek'] = None
-                    last_song.source_func.__defaults__ = tuple(args.values())
-                else:
-                    player.seek_flag = False
-
-            if not player.force_disconnect_flag and not player.disconnect_flag:
-                player.current_index += 1
-                if player.voice_client is not None:
-                    if len(player.voice_client.channel.members) > 1:
-                        # Play next song in the queue
-                        if player.current_index < len(player.queue):
-                            global_state.discord_client.loop.create_task(
-                                player.play(
-                                    player.queue[player.current_index].requester
-                                )
-                            )
-            else:
-                player.force_disconnect_flag = False
+                last_song.track.seek = None
+
+            if player.state is not PlayerState.CONNECTED:
+                return
+            player.queue.advance()
+            next_song = player.queue.current()
+            # Called from the audio player thread, hand over to the event loop
+            global_state.discord_client.loop.call_soon_threadsafe(player.arm_idle_timer)
+            if player.voice_client is not None:
+                if len(player.voice_client.channel.members) > 1:
+                    # Play next song in the queue
+                    if next_song is not None:
+                        asyncio.run_coroutine_threadsafe(
+                            player.play(
+                                next_song.requester
+                            ),
+                            global_state.discord_client.loop
+                        )
         return callback
 
-    def print_queue(self) -> list[str]:
-        ret, now = [], datetime.now()
-        duration_integrity = True  # Turns false if any of the songs doesn't have duration
-        summed_duration = 0
-        for i, s in enumerate(self.queue):
-            args = utils.get_function_default_args(s.source_func)
+    def print_queue(self, history: int = QUEUE_VIEW_HISTORY, upcoming: int = QUEUE_VIEW_UPCOMING) -> list[str]:
+        """
+        One line per song of a window around the current one, long queues end with a summary of the songs left out
+        """
+        ret = []
+        songs, head = self.queue.snapshot()
+        elapsed = self.current_position() or 0
+        start, end = max(head - history, 0), min(head + 1 + upcoming, len(songs))
+        for i in range(start, end):
+            track, position = songs[i].track, i - head
+            title = track.title or '<No Title>'
+            has_duration = track.duration is not None  # Lazily queued songs may not know their duration
+            eta = self.eta(position) if position > 0 else None
             ret.append(
                 "".join([
-                    f"{i - self.current_index}: {args.get('title', '<No Title>')[:40]}",
-                    "" if len(args.get('title', '<No Title>')) < 40 else "...",
-                    f" - {((now - s.time_played).seconds + (args['seek'] if args.get('seek') is not None else 0)) // 60:02}:{((now - s.time_played).seconds + (args['seek'] if args.get('seek') is not None else 0)) % 60:02}/" if 'duration' in args and i == self.current_index else " - ",
-                    f"{args['duration'] // 60:02}:{args['duration'] % 60:02}"
-                    if 'duration' in args else
+                    f"{position}: {title[:40]}",
+                    "" if len(title) < 40 else "...",
+                    f" - {elapsed // 60:02}:{elapsed % 60:02}/" if has_duration and position == 0 else " - ",
+                    f"{track.duration // 60:02}:{track.duration % 60:02}"
+                    if has_duration else
                     "<No Duration>",
-                    f" -> (est. {summed_duration // 60:02}:{summed_duration % 60:02})"
-                    if duration_integrity and 'duration' in args and i > self.current_index else
-                    f" -> (est. N/A)" if i > self.current_index else "",
-                    " ---Playing---" if i == self.current_index else ""
+                    f" -> (est. {eta // 60:02}:{eta % 60:02})"
+                    if eta is not None and has_duration else
+                    f" -> (est. N/A)" if position > 0 else "",
+                    " ---Playing---" if position == 0 else ""
                 ])
             )
-            if 'duration' not in args and i >= self.current_index:
-                duration_integrity = False
-            if duration_integrity and i > self.current_index:
-                summed_duration += args['duration']
-            if duration_integrity and i == self.current_index:
-                summed_duration += (args['duration'] - (now - s.time_played).seconds - (args['seek'] if args.get('seek') is not None else 0))
-
+        if end < len(songs):
+            total = self.eta(len(songs) - head)
+            ret.append(
+                f"... and {len(songs) - end} more "
+                f"(total ETA {f'{total // 60:02}:{total % 60:02}' if total is not None else 'N/A'})"
+            )
         return ret
 
-    async def play(self, caller: Union[Member, User], source_func: Optional[Callable[[], FFmpegPCMAudio]] = None, voice_channel: Optional[VoiceChannel] = None):
+    def eta(self, position: int) -> Optional[int]:
+        """
+        Seconds until the upcoming song at position starts, None if a song before it doesn't know its duration
+        """
+        current = self.queue.current()
+        if current is None or current.track.duration is None:
+            return None
+        upcoming = self.queue.upcoming_duration(position)
+        if upcoming is None:
+            return None
+        return max(current.track.duration - (self.current_position() or 0), 0) + upcoming
+
+    async def play(self, caller: Union[Member, User], track: Optional[Track] = None, voice_channel: Optional[VoiceChannel] = None):
         # Connect to a voice channel if not connected
         await self.connect_to_channel(caller.voice.channel if voice_channel is None else voice_channel)
 
         async with self.voice_client_lock:
             # Append a song if passed as argument
-            if source_func is not None:
-                self.queue.append(Song(source_func, caller))
-        if not self.voice_client.is_playing():
-            song = self.queue[self.current_index]
-            song_args = utils.get_function_default_args(song.source_func)
+            if track is not None:
+                self.queue.append(Song(track, caller))
+        async with self.play_lock:
+            # Building the source awaits extraction, so another play call could start a song meanwhile
+            song = self.queue.current()
+            if self.voice_client.is_playing() or song is None:
+                self.schedule_prefetch()
+                return
 
-            self.voice_client.play(song.source_func(), after=self.finishing_callback())
+            source = await self.take_prefetched_source(song)
+            if source is None:
+                source = await song.track.create_source()
+            self.voice_client.play(source, after=self.finishing_callback())
             song.time_played = datetime.now()
+            self.arm_idle_timer()
+            self.schedule_prefetch()
             requested_ago = song.time_played - song.time_requested
-            if song_args.get('seek') is None:
+            if song.track.seek is None:
                 await self.register_current_song_to_database()
 
             print("".join([
-                f"Info: playing \"{song_args.get('title')}\" requested",
+                f"Info: playing \"{song.track.title}\" requested",
                 f" by {caller.name}#{caller.discriminator} in {caller.guild.name}",
                 f" {requested_ago.__str__().split('.')[0]} ago"
             ]))
 
+    async def enqueue(self, tracks: list[Track], requester: Member):
+        """
+        Appends songs to the queue without starting playback, used for bulk additions
+        """
+        async with self.voice_client_lock:
+            self.queue.extend(Song(t, requester) for t in tracks)
+        if self.voice_client is not None and self.voice_client.is_playing():
+            self.schedule_prefetch()
+
+    def current_position(self) -> Optional[int]:
+        """
+        Seconds into the current song, None if nothing is playing
+        """
+        song = self.queue.current()
+        if song is None or song.time_played is None:
+            return None
+        return (datetime.now() - song.time_played).seconds + (song.track.seek or 0)
+
+    async def seek(self, position: int) -> bool:
+        """
+        Restarts the current song at position seconds by swapping the voice client's source in place
+        The song doesn't stop, so the finishing callback isn't involved and the queue stays untouched
+        """
+        async with self.voice_client_lock:
+            song = self.queue.current()
+            if self.voice_client is None or not self.voice_client.is_playing() or song is None:
+                return False
+            if song.track.duration is not None:
+                position = min(position, song.track.duration - 1)
+            position = max(0, position)
+
+            previous_seek = song.track.seek
+            song.track.seek = position
+            # Reuses the cached stream url or local copy, only ffmpeg gets restarted
+            try:
+                source = await song.track.create_source()
+            except Exception:
+                song.track.seek = previous_seek
+                raise
+
+            # The song could have ended while the new source was being built
+            if self.queue.current() is not song or not self.voice_client.is_playing():
+                source.cleanup()
+                return False
+            old_source = self.voice_client.source
+            try:
+                self.voice_client.source = source
+            except (ClientException, TypeError):
+                song.track.seek = previous_seek
+                source.cleanup()
+                return False
+            song.time_played = datetime.now()
+        old_source.cleanup()
+        return True
+
+    def schedule_prefetch(self):
+        """
+        Starts resolving the song after the current one while the current one plays
+        Does nothing if that song is already being prefetched
+        """
+        next_song = self.queue.get(1)
+        if next_song is self.prefetch_song:
+            return
+        self.invalidate_prefetch()
+        if next_song is None or self.voice_client is None:
+            return
+        self.prefetch_song = next_song
+        self.prefetch_task = global_state.discord_client.loop.create_task(self.prefetch(next_song))
+
+    async def prefetch(self, song: Song):
+        try:
+            if config.music.prefetch_source:
+                # ffmpeg starts reading right away, its output pipe acts as a small buffer
+                source = await song.track.create_source()
+                if self.prefetch_song is not song:
+                    source.cleanup()
+                    return
+                self.prefetched_source = source
+            elif song.track.video_id is not None:
+                await extractor.resolve_stream(song.track.video_id)
+        except Exception as exc:
+            print(f"Error: Couldn't prefetch next song in {self.guild.name}. Details: {exc}")
+
+    async def take_prefetched_source(self, song: Song) -> Optional[AudioSource]:
+        """
+        Returns the prefetched source if it belongs to song, waits for it if still being built
+        """
+        if self.prefetch_song is not song:
+            return None
+        if self.prefetch_task is not None and not self.prefetch_task.done():
+            await asyncio.wait({self.prefetch_task})
+        source = self.prefetched_source if self.prefetch_song is song else None
+        self.prefetched_source = None
+        self.prefetch_song = None
+        self.prefetch_task = None
+        return source
+
+    def invalidate_prefetch(self):
+        """
+        Drops any lookahead work, killing the ffmpeg process that may have been spawned for it
+        """
+        if self.prefetch_task is not None and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
+        if self.prefetched_source is not None:
+            self.prefetched_source.cleanup()
+        self.prefetch_song = None
+        self.prefetch_task = None
+        self.prefetched_source = None
+
     async def connect_to_channel(self, channel: VoiceChannel):
         async with self.voice_client_lock:
             if self.voice_client is None:
@@ -143,54 +286,62 @@ class MusicPlayer:
                     print(f"Error: Already connected to channel {channel.name} in {self.guild.name}. Syncing state")
                     await self.guild.voice_client.disconnect(force=True)
                     self.voice_client: VoiceClient = await channel.connect()
+                self.state = PlayerState.CONNECTED
+                self.arm_idle_timer()
 
     async def register_current_song_to_database(self):
-        cur_song = self.queue[self.current_index]
-
-        class MockSong:
-            def __init__(self, yt_id, name, duration):
-                self.yt_id = yt_id
-                self.name = name
-                self.duration = duration
-
-        args = utils.get_function_default_args(cur_song.source_func)
-        if 'i_yt_id' in args:
-            with database:
-                database.register_song_listeners(
-                    database.register_song(
-                        MockSong(
-                            args['db_youtube_id'],
-                            args['title'],
-                            args['duration']
-                        ), cur_song.requester.id, self.guild.id
-                    ),
-                    [u.id for u in self.voice_client.channel.members]
-                )
-
-    async def cleanup_coro(self, interval: int):
-        while True:
-            await asyncio.sleep(interval)
-
-            # Cleanup song queue
-            if self.current_index > 4:
-                async with self.voice_client_lock:
-                    self.queue = self.queue[self.current_index - 4:]
-                    last_index = self.current_index
-                    self.current_index = 4
-                print(f"Cleanup Info: Removed {last_index - self.current_index} songs from {self.guild.name}'s queue")
-
-            # Cleanup by disconnecting if no one in channel or bot is not playing music
-            if self.voice_client is not None and (len(self.voice_client.channel.members) <= 1 or not self.voice_client.is_playing()):
-                channel_name: str = self.voice_client.channel.name
-                async with self.voice_client_lock:
-                    self.disconnect_flag = True
-
-                    # Have to do this hacky shit since for some godforsaken reason
-                    # calling disconnect doesn't trigger the finishing callback.
-                    # This is fucking stupid.
-                    self.finishing_callback()(None)
-                    await self.voice_client.disconnect()
-
-                    self.current_index = len(self.queue)
-                    self.voice_client: Optional[VoiceClient] = None
-                print(f"Cleanup Info: Disconnected voice client from \"{channel_name}\" in {self.guild.name}")
+        cur_song = self.queue.current()
+
+        track = cur_song.track
+        if track.kind is SourceKind.YOUTUBE:
+            telemetry_writer.register_song_play(
+                SongRecord(
+                    track.video_id,
+                    track.title,
+                    track.duration,
+                    track.thumbnail
+                ), cur_song.requester.id, self.guild.id,
+                [u.id for u in self.voice_client.channel.members]
+            )
+
+    def arm_idle_timer(self):
+        """
+        (Re)starts the countdown to check whether the player is still in use, only while connected
+        """
+        if self.state is PlayerState.CONNECTED:
+            scheduler.schedule(self.idle_key, config.music.idle_timeout, self.idle_check)
+
+    async def idle_check(self):
+        if self.voice_client is None or self.state is not PlayerState.CONNECTED:
+            return
+        # Still in use, check again later
+        if len(self.voice_client.channel.members) > 1 and self.voice_client.is_playing():
+            self.arm_idle_timer()
+            return
+        channel_name: str = self.voice_client.channel.name
+        await self.disconnect()
+        print(f"Cleanup Info: Disconnected voice client from \"{channel_name}\" in {self.guild.name}")
+
+    async def disconnect(self, finish_queue: bool = True):
+        """
+        Leaves the voice channel, playback stops without advancing the queue
+        With finish_queue every song left moves to the history, otherwise the current song plays again on the next play
+        Also used when the bot was disconnected by someone else, to sync the state
+        """
+        async with self.voice_client_lock:
+            if self.state is not PlayerState.CONNECTED:
+                return
+            self.state = PlayerState.DISCONNECTING
+            scheduler.cancel(self.idle_key)
+            current = self.queue.current()
+            if current is not None:
+                current.track.seek = None
+            if finish_queue:
+                self.queue.finish()
+            self.invalidate_prefetch()
+            try:
+                if self.voice_client is not None:
+                    await self.voice_client.disconnect(force=True)
+            finally:
+                self.voice_client = None
+                self.state = PlayerState.DISCONNECTED
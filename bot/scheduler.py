@@ -0,0 +1,78 @@
+"""
+Single task running the bot's deadlines instead of a sleeping task per deadline
+"""
+import asyncio
+import heapq
+import itertools
+from typing import Callable, Awaitable, Hashable, Optional
+
+
+class Scheduler:
+    """
+    Deadlines are kept in a heap ordered by time, each one identified by a key
+    Re-arming or cancelling a key leaves its old heap entry behind, it's skipped once it reaches the top
+    Must only be used from the event loop's thread
+    """
+    def __init__(self):
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._deadlines: dict[Hashable, tuple[int, Callable[[], Awaitable[None]]]] = {}  # key -> (entry id, callback)
+        self._entry_ids = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None  # Created with the task, on the loop that runs it
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], Awaitable[None]]):
+        """
+        Runs callback in delay seconds, replacing the deadline key had if any
+        """
+        loop = asyncio.get_running_loop()
+        entry_id = next(self._entry_ids)
+        heapq.heappush(self._heap, (loop.time() + delay, entry_id, key))
+        self._deadlines[key] = (entry_id, callback)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        if self._heap[0][1] == entry_id:
+            self._wakeup.set()  # New earliest deadline
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def pending(self) -> int:
+        return len(self._deadlines)
+
+    def _is_stale(self, entry_id: int, key: Hashable) -> bool:
+        deadline = self._deadlines.get(key)
+        return deadline is None or deadline[0] != entry_id
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while len(self._heap) > 0 and self._is_stale(self._heap[0][1], self._heap[0][2]):
+                heapq.heappop(self._heap)
+            if len(self._heap) == 0:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            _, _, key = heapq.heappop(self._heap)
+            _, callback = self._deadlines.pop(key)
+            loop.create_task(self._fire(key, callback))
+
+    @staticmethod
+    async def _fire(key: Hashable, callback: Callable[[], Awaitable[None]]):
+        try:
+            await callback()
+        except Exception as exc:
+            print(f"Error: Scheduled task {key} failed. Details: {exc}")
+
+
+scheduler = Scheduler()
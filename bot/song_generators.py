@@ -1,63 +1,110 @@
 from copy import deepcopy
 from datetime import timedelta
-from typing import Optional, Callable
+from typing import Optional
 
-from discord import FFmpegPCMAudio
-from yt_dlp import YoutubeDL
+from discord import FFmpegOpusAudio
 
-FFMPEG_YT_OPTIONS = {'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', 'options': '-vn'}
+from bot.audio_cache import audio_cache
+from bot.stream_fanout import StreamFanout
+from bot.track import Track, SourceKind
+from bot.yt_extractor import extractor, ResolvedStream
+from config import config
+from database.async_db import async_database
 
+# All decoding and encoding happens in one ffmpeg process per stream, so the OS spreads it over every core.
+# Keep each of them on a single thread so dozens of concurrent streams don't oversubscribe the machine.
+FFMPEG_OUTPUT_OPTIONS = '-vn -threads 1'
+FFMPEG_YT_OPTIONS = {'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5', 'options': FFMPEG_OUTPUT_OPTIONS}
 
-# Use factory pattern to embed different types of playable audio as a function
-async def generate_youtube_song(yt_id: str, e_seek: Optional[int] = None) -> Callable[[], FFmpegPCMAudio]:
-    outer_yt_query = YoutubeDL(
-        {'format': 'bestaudio/best', 'quiet': True, 'noplaylist': True}
-    ).extract_info(yt_id, download=False)
+fanout = StreamFanout(config.music.fanout_window)
+
+
+def make_youtube_source(stream: ResolvedStream, ffmpeg_options: dict) -> FFmpegOpusAudio:
+    """
+    Builds an opus source that lets ffmpeg copy opus packets as is,
+    any other codec gets transcoded to opus inside ffmpeg instead of in a python thread
+    FFmpegOpusAudio only copies when told the input codec is opus, anything else it re-encodes
+    """
+    return FFmpegOpusAudio(
+        source=stream.url,
+        codec=stream.acodec,
+        **ffmpeg_options
+    )
+
+
+def seek_options(seek: Optional[int]) -> str:
+    """
+    ffmpeg input options to start playing at seek seconds, empty if no seeking was requested
+    """
+    if seek is None:
+        return ''
+    seek_time = timedelta(seconds=seek)
+    return ''.join([
+        ' -ss ',
+        f'{seek_time.seconds // 3600}:',
+        f'{seek_time.seconds // 60 % 60}:',
+        f'{seek_time.seconds % 60}'
+    ])
+
+
+async def youtube_source(track: Track) -> FFmpegOpusAudio:
+    # Local copies start instantly and seek without touching the network
+    cached_path = audio_cache.lookup(track.video_id)
+    if cached_path is not None:
+        return await FFmpegOpusAudio.from_probe(
+            cached_path,
+            before_options=seek_options(track.seek),
+            options=FFMPEG_OUTPUT_OPTIONS
+        )
+
+    ffmpeg_options = deepcopy(FFMPEG_YT_OPTIONS)
+    ffmpeg_options['before_options'] += seek_options(track.seek)
+
+    # Resolve by video id, re-running a search query could land on a different video
+    stream = await extractor.resolve_stream(track.video_id)
+    if track.seek is None and fanout.is_enabled():
+        return fanout.attach(track.video_id, lambda: make_youtube_source(stream, ffmpeg_options))
+    return make_youtube_source(stream, ffmpeg_options)
+
+
+async def url_source(track: Track) -> FFmpegOpusAudio:
+    ffmpeg_options = {'options': FFMPEG_OUTPUT_OPTIONS, 'before_options': seek_options(track.seek)}
+    # Probing tells whether the file is already opus and can be passed through
+    return await FFmpegOpusAudio.from_probe(track.query, **ffmpeg_options)
+
+
+async def generate_youtube_song(yt_id: str, e_seek: Optional[int] = None) -> Track:
+    if not yt_id.startswith("ytsearch:"):
+        # Known videos already have their metadata stored, only their stream is resolved when played
+        stored = await async_database.get_track(yt_id)
+        if stored is not None:
+            return Track(
+                SourceKind.YOUTUBE, yt_id, youtube_source,
+                stored.title, stored.duration, stored.thumbnail, stored.youtube_id, e_seek
+            )
+
+    outer_yt_query = await extractor.extract(yt_id)
     if yt_id.startswith("ytsearch:"):
         outer_yt_query = outer_yt_query['entries'][0]
-    e_title, e_duration, e_thumbnail = outer_yt_query.get('title'), outer_yt_query.get('duration'), outer_yt_query.get('thumbnail')
-
-    def youtube_song(i_yt_id=yt_id, seek=e_seek, title=e_title, duration=e_duration, thumbnail=e_thumbnail, db_youtube_id=outer_yt_query.get('id')):  # Default params for early binding
-        ffmpeg_options = deepcopy(FFMPEG_YT_OPTIONS)
-        # Add seeking if requested
-        if seek is not None:
-            seek_time = timedelta(seconds=seek)
-            ffmpeg_options['before_options'] += ''.join([
-                ' -ss ',
-                f'{seek_time.seconds // 3600}:',
-                f'{seek_time.seconds // 60 % 60}:',
-                f'{seek_time.seconds % 60}'
-            ])
-
-        yt_query = YoutubeDL(
-            {'format': 'bestaudio/best', 'quiet': True, 'noplaylist': True}
-        ).extract_info(i_yt_id, download=False)
-        if i_yt_id.startswith("ytsearch:"):
-            yt_query = yt_query['entries'][0]
-        audio_format: str = yt_query['format_id']
-        audio_url = [
-            x for x in yt_query['formats']
-            if x['format_id'] == audio_format
-        ][0]['url']
-
-        # Make it so this function returns the audio_url instead of the FFmpegPCMAudio to allow for faster seeking
-        # Ignore previous comment, use a cache with the url
-        return FFmpegPCMAudio(source=audio_url, **ffmpeg_options)
-    return youtube_song
-
-
-async def generate_url_song(url: str) -> Callable[[], FFmpegPCMAudio]:
-    e_title = url.split('/')[-1].split('.')[0]
-
-    def url_song(i_url=url, seek=0, title=e_title):
-        ffmpeg_options = {}
-        if seek is not None:
-            seek_time = timedelta(seconds=seek)
-            ffmpeg_options['before_options'] = ''.join([
-                ' -ss ',
-                f'{seek_time.seconds // 3600}:',
-                f'{seek_time.seconds // 60 % 60}:',
-                f'{seek_time.seconds % 60}'
-            ])
-        return FFmpegPCMAudio(source=i_url, **ffmpeg_options)
-    return url_song
+    extractor.cache_stream(outer_yt_query)  # Play time resolution will most likely hit this
+    return Track(
+        SourceKind.YOUTUBE, yt_id, youtube_source,
+        outer_yt_query.get('title'), outer_yt_query.get('duration'), outer_yt_query.get('thumbnail'),
+        outer_yt_query.get('id'), e_seek
+    )
+
+
+def generate_lazy_youtube_song(entry: dict) -> Track:
+    """
+    Builds a song out of a flat playlist entry, resolving its audio is deferred until it's about to play
+    """
+    thumbnails = entry.get('thumbnails')
+    return Track(
+        SourceKind.YOUTUBE, entry['id'], youtube_source,
+        entry.get('title'), entry.get('duration'), thumbnails[-1]['url'] if thumbnails else None,
+        entry['id']
+    )
+
+
+async def generate_url_song(url: str) -> Track:
+    return Track(SourceKind.URL, url, url_source, url.split('/')[-1].split('.')[0])
@@ -0,0 +1,135 @@
+import random
+import threading
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bot.music_player import Song
+
+
+class SongQueue:
+    """
+    Played songs (bounded history), the current song and the upcoming ones, addressed by position:
+    0 is the current song, negative positions are the history and positive ones are upcoming
+    Prefix sums of the durations give the time until any upcoming song without walking the queue
+    Every method holds a lock so the web api thread can read it while the bot mutates it
+    """
+    def __init__(self, history_size: int):
+        self.history_size = history_size
+        self._lock = threading.Lock()
+        self._songs: list['Song'] = []
+        self._head = 0  # Index of the current song, len(_songs) when nothing is left to play
+        self._durations: list[int] = [0]  # _durations[i] is the summed known duration of _songs[:i]
+        self._unknown: list[int] = [0]  # _unknown[i] is how many of _songs[:i] don't know their duration
+
+    def __len__(self) -> int:
+        """
+        Amount of songs left to play, the current one included
+        """
+        with self._lock:
+            return len(self._songs) - self._head
+
+    def get(self, position: int) -> Optional['Song']:
+        with self._lock:
+            index = self._head + position
+            return self._songs[index] if 0 <= index < len(self._songs) else None
+
+    def current(self) -> Optional['Song']:
+        return self.get(0)
+
+    def append(self, song: 'Song'):
+        self.extend([song])
+
+    def extend(self, songs: list['Song']):
+        with self._lock:
+            for s in songs:
+                self._songs.append(s)
+                duration = s.track.duration
+                self._durations.append(self._durations[-1] + (duration or 0))
+                self._unknown.append(self._unknown[-1] + (duration is None))
+
+    def advance(self, n: int = 1):
+        """
+        Moves n songs forward (backwards if negative) without going past the end or the history
+        """
+        with self._lock:
+            self._head = min(max(self._head + n, 0), len(self._songs))
+            if self._head > 2 * self.history_size:
+                self._trim_history()
+
+    def finish(self):
+        """
+        Moves every song left to the history, nothing is current afterwards
+        """
+        with self._lock:
+            self._head = len(self._songs)
+            if self._head > 2 * self.history_size:
+                self._trim_history()
+
+    def upcoming_duration(self, position: int) -> Optional[int]:
+        """
+        Summed duration of the upcoming songs before position, None if any of them doesn't know its duration
+        """
+        with self._lock:
+            start, end = self._head + 1, min(self._head + position, len(self._songs))
+            if end <= start:
+                return 0
+            if self._unknown[end] - self._unknown[start] > 0:
+                return None
+            return self._durations[end] - self._durations[start]
+
+    def shuffle(self):
+        """
+        Shuffles the upcoming songs in place
+        """
+        with self._lock:
+            start = self._head + 1
+            for i in range(len(self._songs) - 1, start, -1):
+                j = random.randint(start, i)
+                self._songs[i], self._songs[j] = self._songs[j], self._songs[i]
+            self._rebuild_sums(start)
+
+    def move(self, position: int, new_position: int) -> bool:
+        """
+        Moves an upcoming song to another upcoming position
+        """
+        with self._lock:
+            index, new_index = self._head + position, self._head + new_position
+            if not (position > 0 and new_position > 0 and index < len(self._songs) and new_index < len(self._songs)):
+                return False
+            self._songs.insert(new_index, self._songs.pop(index))
+            self._rebuild_sums(min(index, new_index))
+            return True
+
+    def remove(self, position: int) -> Optional['Song']:
+        """
+        Removes an upcoming song, returns it
+        """
+        with self._lock:
+            index = self._head + position
+            if not (position > 0 and index < len(self._songs)):
+                return None
+            song = self._songs.pop(index)
+            del self._durations[-1], self._unknown[-1]
+            self._rebuild_sums(index)
+            return song
+
+    def snapshot(self) -> tuple[list['Song'], int]:
+        """
+        Copy of every song and the index of the current one within it, consistent even while being mutated
+        """
+        with self._lock:
+            return list(self._songs), self._head
+
+    def _rebuild_sums(self, start: int):
+        for i in range(start, len(self._songs)):
+            duration = self._songs[i].track.duration
+            self._durations[i + 1] = self._durations[i] + (duration or 0)
+            self._unknown[i + 1] = self._unknown[i] + (duration is None)
+
+    def _trim_history(self):
+        drop = self._head - self.history_size
+        del self._songs[:drop]
+        # Sums are only ever subtracted from each other, the dropped offset doesn't need removing
+        del self._durations[:drop]
+        del self._unknown[:drop]
+        self._head -= drop
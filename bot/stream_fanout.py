@@ -0,0 +1,149 @@
+"""
+Lets guilds that start the same track at about the same time share a single ffmpeg pipeline
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+from discord import AudioSource
+
+TRIM_THRESHOLD = 250  # Buffered frames (5 seconds) before trimming what every subscriber already read
+TRIM_GRACE = 2  # Seconds after the join window closes for late subscribers to start reading
+
+
+class SharedStream:
+    """
+    Buffers the frames of one underlying source so that several subscribers can read them at their own pace
+    Frames are pulled from the underlying source by whichever subscriber is furthest ahead
+    """
+    def __init__(self, key: str, source: AudioSource, window: float):
+        self.key = key
+        self.source = source
+        self.window = window
+        self.lock = threading.Lock()
+        self.frames: list[bytes] = []
+        self.base = 0  # Absolute index of frames[0]
+        self.subscribers: set[FanoutSource] = set()
+        self.first_read: Optional[float] = None
+        self.finished = False
+
+    def is_joinable(self) -> bool:
+        return self.base == 0 and (self.first_read is None or time.monotonic() - self.first_read <= self.window)
+
+    def read(self, subscriber: 'FanoutSource') -> Optional[bytes]:
+        """
+        Returns None if the frames the subscriber needs were already trimmed
+        """
+        with self.lock:
+            if self.first_read is None:
+                self.first_read = time.monotonic()
+            if subscriber.position < self.base:
+                return None
+            while subscriber.position - self.base >= len(self.frames) and not self.finished:
+                frame = self.source.read()
+                if not frame:
+                    self.finished = True
+                    break
+                self.frames.append(frame)
+            if subscriber.position - self.base >= len(self.frames):
+                return b''
+
+            frame = self.frames[subscriber.position - self.base]
+            subscriber.position += 1
+            subscriber.started = True
+
+            # Once nobody can join anymore, subscribers that haven't started don't hold the buffer back.
+            # They fall back to a private pipeline instead.
+            if len(self.frames) >= TRIM_THRESHOLD and time.monotonic() - self.first_read > self.window + TRIM_GRACE:
+                lowest = min(s.position for s in self.subscribers if s.started)
+                if lowest > self.base:
+                    del self.frames[:lowest - self.base]
+                    self.base = lowest
+            return frame
+
+
+class FanoutSource(AudioSource):
+    """
+    Audio source reading from a SharedStream
+    If it was attached long before playing and the shared buffer moved on, it builds its own source instead
+    """
+    def __init__(self, fanout: 'StreamFanout', shared: SharedStream, source_factory: Callable[[], AudioSource]):
+        self.fanout = fanout
+        self.shared: Optional[SharedStream] = shared
+        self.source_factory = source_factory
+        self.private_source: Optional[AudioSource] = None
+        self.position = 0
+        self.started = False
+
+    def read(self) -> bytes:
+        if self.private_source is not None:
+            return self.private_source.read()
+        if self.shared is None:
+            return b''
+        frame = self.shared.read(self)
+        if frame is None:
+            self.fanout.detach(self)
+            self.private_source = self.source_factory()
+            return self.private_source.read()
+        return frame
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if self.private_source is not None:
+            self.private_source.cleanup()
+            self.private_source = None
+        self.fanout.detach(self)
+
+
+class StreamFanout:
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._streams: dict[str, SharedStream] = {}
+        self.pipelines_created = 0
+        self.streams_deduplicated = 0
+
+    def is_enabled(self) -> bool:
+        return self.window > 0
+
+    def attach(self, key: str, source_factory: Callable[[], AudioSource]) -> AudioSource:
+        """
+        Returns a source for key, sharing the pipeline of one started less than window seconds ago if possible
+        source_factory must build an opus source that plays key from the start
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is not None and shared.is_joinable():
+                self.streams_deduplicated += 1
+            else:
+                shared = SharedStream(key, source_factory(), self.window)
+                self._streams[key] = shared
+                self.pipelines_created += 1
+            subscriber = FanoutSource(self, shared, source_factory)
+            with shared.lock:
+                shared.subscribers.add(subscriber)
+            return subscriber
+
+    def detach(self, subscriber: FanoutSource):
+        with self._lock:
+            shared, subscriber.shared = subscriber.shared, None
+            if shared is None:
+                return
+            with shared.lock:
+                shared.subscribers.discard(subscriber)
+                if len(shared.subscribers) > 0:
+                    return
+            # Last subscriber gone, release the pipeline
+            if self._streams.get(shared.key) is shared:
+                del self._streams[shared.key]
+            shared.source.cleanup()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'active_pipelines': len(self._streams),
+                'pipelines_created': self.pipelines_created,
+                'streams_deduplicated': self.streams_deduplicated
+            }
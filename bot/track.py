@@ -0,0 +1,51 @@
+from enum import Enum
+from typing import Callable, Awaitable, Optional
+
+from discord import AudioSource
+
+
+class SourceKind(Enum):
+    YOUTUBE = 0
+    URL = 1
+
+
+class Track:
+    """
+    Metadata of a playable song, its audio is only built by source_factory once it's about to play
+    source_factory is shared by every track of the same kind and gets the track to build the audio of
+    """
+    __slots__ = ('kind', 'query', 'source_factory', 'title', 'duration', 'thumbnail', 'video_id', 'seek')
+
+    def __init__(
+            self,
+            kind: SourceKind,
+            query: str,
+            source_factory: Callable[['Track'], Awaitable[AudioSource]],
+            title: Optional[str] = None,
+            duration: Optional[int] = None,
+            thumbnail: Optional[str] = None,
+            video_id: Optional[str] = None,
+            seek: Optional[int] = None
+    ):
+        self.kind = kind
+        self.query = query  # What the user asked for, a video id, a search or an url
+        self.source_factory = source_factory
+        self.title = title
+        self.duration = duration  # Seconds, None if unknown
+        self.thumbnail = thumbnail
+        self.video_id = video_id  # Resolved youtube video id
+        self.seek = seek  # Seconds into the song the next source starts at, None to start from the beginning
+
+    async def create_source(self) -> AudioSource:
+        return await self.source_factory(self)
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind.name.lower(),
+            'query': self.query,
+            'title': self.title,
+            'duration': self.duration,
+            'thumbnail': self.thumbnail,
+            'video_id': self.video_id,
+            'seek': self.seek
+        }
@@ -0,0 +1,149 @@
+"""
+Runs yt-dlp extractions in a bounded thread pool so the discord event loop never blocks on them
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+from yt_dlp import YoutubeDL
+
+from config import config
+
+# Option sets for the YoutubeDL instances kept by each worker thread
+YDL_PROFILES = {
+    # Prefer opus formats so that playback can pass packets through without transcoding
+    'audio': {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'quiet': True, 'noplaylist': True},
+    'flat_playlist': {'format': 'bestaudio/best', 'quiet': True, 'extract_flat': True},
+    'cache_download': {
+        'format': 'bestaudio[acodec=opus]/bestaudio',
+        'quiet': True,
+        'noplaylist': True,
+        'outtmpl': os.path.join(config.music.audio_cache_dir, '%(id)s.%(ext)s'),
+        # Keep a single long video from taking over the cache
+        'max_filesize': config.music.audio_cache_max_mb * 1024 * 1024 // 20 or None
+    },
+}
+
+STREAM_DEFAULT_TTL = 3600  # Used when the audio url doesn't say when it expires
+STREAM_EXPIRE_MARGIN = 300  # Consider urls stale a bit early so ffmpeg never opens a dead one
+
+
+class ResolvedStream:
+    """
+    POD-like class holding a playable audio url and the metadata of its format
+    """
+    def __init__(self, video_id: str, url: str, format_id: str, acodec: Optional[str], abr: Optional[float]):
+        self.video_id = video_id
+        self.url = url
+        self.format_id = format_id
+        self.acodec = acodec
+        self.abr = abr
+        self.expires_at: float = stream_url_expiration(url) - STREAM_EXPIRE_MARGIN
+
+    def is_expired(self) -> bool:
+        return self.expires_at <= time.time()
+
+
+def stream_url_expiration(url: str) -> float:
+    """
+    Reads the expire parameter googlevideo urls carry, either in the query or as a path segment
+    """
+    expire = parse_qs(urlparse(url).query).get('expire')
+    if expire is not None and expire[0].isdigit():
+        return float(expire[0])
+    path_expire = re.search(r"/expire/(\d+)", url)
+    if path_expire is not None:
+        return float(path_expire.group(1))
+    return time.time() + STREAM_DEFAULT_TTL
+
+
+class YoutubeExtractor:
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(workers, self.__class__.__name__)
+        # YoutubeDL instances are not thread safe, each worker builds and reuses its own
+        self._local = threading.local()
+
+        # Process wide stream url cache, only touched from the event loop
+        self._streams: dict[str, ResolvedStream] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._stream_inserts = 0
+
+    def _get_ydl(self, profile: str) -> YoutubeDL:
+        instances: dict[str, YoutubeDL] = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        if profile not in instances:
+            instances[profile] = YoutubeDL(YDL_PROFILES[profile])
+        return instances[profile]
+
+    def _extract(self, query: str, profile: str, params: dict, download: bool = False) -> dict:
+        ydl = self._get_ydl(profile)
+        # Per call parameters are swapped in and out of the reused instance
+        previous = {k: ydl.params.get(k) for k in params}
+        ydl.params.update(params)
+        try:
+            return ydl.extract_info(query, download=download)
+        finally:
+            ydl.params.update(previous)
+
+    async def extract(self, query: str, profile: str = 'audio', **params) -> dict:
+        """
+        Awaitable equivalent of YoutubeDL.extract_info(query, download=False)
+        Extra keyword arguments override the profile's YoutubeDL params for this call only
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._extract, query, profile, params
+        )
+
+    async def download(self, query: str, profile: str = 'cache_download') -> dict:
+        """
+        Awaitable equivalent of YoutubeDL.extract_info(query, download=True)
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._extract, query, profile, {}, True
+        )
+
+    def cache_stream(self, info: dict) -> ResolvedStream:
+        """
+        Stores the audio url of an already extracted video, returns the cached entry
+        """
+        audio_format = [
+            x for x in info['formats']
+            if x['format_id'] == info['format_id']
+        ][0]
+        stream = ResolvedStream(info['id'], audio_format['url'], info['format_id'], audio_format.get('acodec'), audio_format.get('abr'))
+        self._streams[stream.video_id] = stream
+        self._stream_inserts += 1
+
+        # Sweep once in a while so videos played only once don't pile up
+        if self._stream_inserts % 256 == 0:
+            self._streams = {k: v for k, v in self._streams.items() if not v.is_expired()}
+        return stream
+
+    async def resolve_stream(self, video_id: str) -> ResolvedStream:
+        """
+        Returns a playable audio url for a video id, extracting only if no fresh one is cached
+        Concurrent calls for the same id share a single extraction
+        """
+        cached = self._streams.get(video_id)
+        if cached is not None and not cached.is_expired():
+            return cached
+
+        inflight = self._inflight.get(video_id)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._resolve_uncached(video_id))
+            self._inflight[video_id] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(video_id, None))
+        # Shield so that a cancelled caller doesn't cancel the extraction for everyone else
+        return await asyncio.shield(inflight)
+
+    async def _resolve_uncached(self, video_id: str) -> ResolvedStream:
+        return self.cache_stream(await self.extract(video_id))
+
+
+extractor = YoutubeExtractor(config.music.extractor_workers)
@@ -1,6 +1,7 @@
 import json
 import os.path
 from json import JSONDecodeError
+from typing import Literal
 
 from pydantic import BaseModel, ValidationError
 
@@ -8,6 +9,10 @@ from pydantic import BaseModel, ValidationError
 class DiscordModel(BaseModel):
     token: str
     info_message: str
+    # "all" caches every member of every guild, "voice" only voice connected and recently active members.
+    # Every 10k cached members cost about 5.6 MB, measured by benchmarks/member_cache.py.
+    member_cache: Literal["all", "voice"] = "all"
+    recent_members: int = 500  # Members kept per guild after running a command, when member_cache is "voice"
 
 
 class ServerModel(BaseModel):
@@ -15,9 +20,41 @@ class ServerModel(BaseModel):
     domain: str
 
 
+class MusicModel(BaseModel):
+    extractor_workers: int = 4  # Max number of concurrent yt-dlp extractions
+    prefetch_source: bool = True  # Spawn the next song's ffmpeg process ahead of time, not just resolve it
+    fanout_window: float = 0  # Seconds within which guilds starting the same song share its pipeline, 0 disables
+    query_concurrency: int = 3  # Searches resolved at once for a single "+p a | b | c" request
+    playlist_page_size: int = 50  # Playlist entries fetched per flat extraction
+    playlist_max_items: int = 500
+    queue_history: int = 4  # Played songs kept in the queue
+    idle_timeout: int = 120  # Seconds without playing or listeners before leaving the voice channel
+    audio_cache_dir: str = "audio_cache"
+    audio_cache_max_mb: int = 1024  # 0 disables the on-disk cache
+    audio_cache_refresh: int = 900  # Seconds between downloads of newly popular songs
+    audio_cache_top_n: int = 10  # Most played songs of each server (and globally) to keep cached
+
+
+class DatabaseModel(BaseModel):
+    read_pool_size: int = 4  # Read only connections shared by the web api
+    cache_size_mb: int = 16  # Page cache of each connection
+    mmap_size_mb: int = 256
+    write_batch_size: int = 500  # Telemetry writes per transaction
+    write_flush_interval: float = 2  # Seconds telemetry writes may wait before being committed
+    write_max_pending: int = 20000  # Buffered telemetry writes before new ones get dropped
+    retention_days: int = 90  # Raw command logs and song listeners kept, older ones are rolled up and archived. 0 keeps everything
+    retention_interval: int = 21600  # Seconds between maintenance runs
+    retention_batch_size: int = 2000  # Rows archived and deleted per transaction
+    archive_dir: str = "archive"
+    vacuum_pages: int = 1000  # Free pages returned to the OS per transaction
+    membership_sync_chunk: int = 10  # Guilds whose members are synced per transaction at startup
+
+
 class Configuration(BaseModel):
     discord: DiscordModel
     server: ServerModel
+    music: MusicModel = MusicModel()
+    database: DatabaseModel = DatabaseModel()
 
 
 # Start of configuration, shall only run the first time this module is imported
@@ -32,7 +69,9 @@ if not os.path.exists("config.json"):
             server=ServerModel(
                 port=5000,
                 domain="localhost"
-            )
+            ),
+            music=MusicModel(),
+            database=DatabaseModel()
         ).dict(), f, indent=4)
         print("Warning: Generated missing config.json, please fill it out and relaunch the program")
         exit(1)
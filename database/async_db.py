@@ -0,0 +1,90 @@
+"""
+Awaitable facade over the database for the bot, queries run on a dedicated thread
+so that the event loop never blocks on them and never awaits while holding the database
+"""
+from typing import Optional
+
+from database.db_controller import database, WebKeyStatus, TrackInfo
+from utils import make_class_methods_threaded
+
+
+@make_class_methods_threaded(awaitable=True)
+class AsyncDB:
+    def sync_servers(self, servers: list[tuple[int, str, int, list[tuple[int, str]]]], prune: bool = True) -> tuple[int, int]:
+        """
+        Registers (server id, name, owner id, members) of every server and brings their memberships up to date
+        in a single transaction, returns how many memberships were added and removed
+        Without prune, members are only added, for member lists that aren't complete
+        """
+        added, removed = 0, 0
+        with database:
+            for server_id, server_name, owner_id, members in servers:
+                # The owner may not be cached, its id stands in for its name until it's seen
+                database.register_users([(owner_id, str(owner_id))], rename=False)
+                database.register_users(members)
+                database.register_server(server_id, server_name, owner_id)
+                if prune:
+                    s_added, s_removed = database.sync_memberships(server_id, [m[0] for m in members])
+                else:
+                    s_added, s_removed = database.register_memberships(server_id, [m[0] for m in members]), 0
+                added, removed = added + s_added, removed + s_removed
+        return added, removed
+
+    def register_member(self, server_id: int, user_id: int, user_name: str):
+        with database:
+            database.register_users([(user_id, user_name)])
+            database.register_memberships(server_id, [user_id])
+
+    def remove_membership(self, server_id: int, user_id: int):
+        with database:
+            database.remove_membership(server_id, user_id)
+
+    def get_top_songs_local(self, user_discord_id: int, server_discord_id: int, amount=10, days: Optional[int] = None) -> list[tuple]:
+        with database.read():
+            return database.get_top_songs_local(user_discord_id, server_discord_id, amount, days).fetchall()
+
+    def get_top_songs_global(self, user_discord_id: int, amount=10, days: Optional[int] = None) -> list[tuple]:
+        with database.read():
+            return database.get_top_songs_global(user_discord_id, amount, days).fetchall()
+
+    def get_top_songs_server(self, server_discord_id: int, amount=10, days: Optional[int] = None) -> list[tuple]:
+        with database.read():
+            return database.get_top_songs_server(server_discord_id, amount, days).fetchall()
+
+    def get_track(self, yt_id: str) -> Optional[TrackInfo]:
+        with database.read():
+            return database.get_track(yt_id)
+
+    def get_hot_video_ids(self, server_discord_ids: list[int], amount=10) -> list[str]:
+        """
+        Most played songs globally followed by the most played of each server, without repeats
+        """
+        ret: list[str] = []
+        with database.read():
+            ret.extend(x[1] for x in database.get_top_songs_all(amount).fetchall())
+            for server_id in server_discord_ids:
+                try:
+                    ret.extend(x[1] for x in database.get_top_songs_server(server_id, amount).fetchall())
+                except LookupError:
+                    continue  # Server not registered yet
+        return list(dict.fromkeys(ret))
+
+    def get_web_keys_status(self, user_id: int) -> Optional[WebKeyStatus]:
+        with database.read():
+            return database.get_web_keys_status(user_id)
+
+    def register_new_web_key(self, user_id: int, key: str, token: str):
+        with database:
+            database.register_new_web_key(user_id, key, token)
+
+    def regenerate_token(self, db_key_id: int, token: str):
+        with database:
+            database.regenerate_token(db_key_id, token)
+
+    def regenerate_key_and_token(self, db_key_id: int, key: str, token: str):
+        with database:
+            database.regenerate_key(db_key_id, key)
+            database.regenerate_token(db_key_id, token)
+
+
+async_database = AsyncDB()
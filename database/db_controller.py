@@ -1,13 +1,21 @@
+import json
+from contextlib import contextmanager
+from queue import Queue
 from typing import Iterable, Union, Optional
 
 from pydantic import BaseModel
 
+import database.migrations as migrations
+import database.queries as queries
 import database.schema as schema
 import sqlite3
+import threading
 from os.path import isfile
 from datetime import datetime, timedelta
 from threading import Lock
 
+from config import config
+
 
 class WebKeyStatus(BaseModel):
     id: int
@@ -18,28 +26,157 @@ class WebKeyStatus(BaseModel):
     key: Optional[str]
 
 
+class TrackInfo(BaseModel):
+    id: int
+    youtube_id: str
+    title: str
+    duration: Optional[int]
+    thumbnail: Optional[str]
+
+
 class DB:
     db_file_name = 'savedata.db'
 
     def __enter__(self):
         self.lock.acquire()
-        self.con = sqlite3.connect(self.db_file_name)
-        self.cur = self.con.cursor()
+        self.con = self._writer
+        self.cur = self._writer.cursor()
         return self
 
     def __exit__(self, exception_type, exception_value, tb):
-        self.con.commit()
-        self.con.close()
+        if exception_type is None:
+            self.con.commit()
+        else:
+            self.con.rollback()
+            self.clear_identity_map()  # Rows it learned about in this transaction may be gone
         self.con = None
         self.cur = None
         self.lock.release()
 
     def __init__(self):
-        self.con: Union[sqlite3.Connection, None] = None
-        self.cur: Union[sqlite3.Cursor, None] = None
-        self.lock = Lock()
-        if not isfile(self.db_file_name):
+        # Connections are long lived, each thread sees the one it's currently using
+        self._local = threading.local()
+        self.lock = Lock()  # Single writer
+
+        # Identity map from discord ids to row ids, rows are never deleted so entries stay valid
+        self._user_fks: dict[int, int] = {}
+        self._server_fks: dict[int, int] = {}
+        self._memberships: set[tuple[int, int]] = set()  # (server fk, user fk), invalidated on removal
+        self._track_fks: dict[str, int] = {}
+        new_database = not isfile(self.db_file_name)
+        self._writer = self._connect()
+        if new_database:
             self.create_database()
+        migrations.migrate(self._writer)
+
+        # WAL lets these run concurrently with the writer
+        self._readers: Queue[sqlite3.Connection] = Queue()
+        for _ in range(config.database.read_pool_size):
+            self._readers.put(self._connect(read_only=True))
+
+    @property
+    def con(self) -> Union[sqlite3.Connection, None]:
+        return getattr(self._local, 'con', None)
+
+    @con.setter
+    def con(self, value: Union[sqlite3.Connection, None]):
+        self._local.con = value
+
+    @property
+    def cur(self) -> Union[sqlite3.Cursor, None]:
+        return getattr(self._local, 'cur', None)
+
+    @cur.setter
+    def cur(self, value: Union[sqlite3.Cursor, None]):
+        self._local.cur = value
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            con = sqlite3.connect(f"file:{self.db_file_name}?mode=ro", uri=True, check_same_thread=False, cached_statements=256)
+        else:
+            con = sqlite3.connect(self.db_file_name, check_same_thread=False, cached_statements=256)
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, only skips fsync on every commit
+        con.execute(f"PRAGMA cache_size = -{config.database.cache_size_mb * 1024}")
+        con.execute(f"PRAGMA mmap_size = {config.database.mmap_size_mb * 1024 * 1024}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        con.execute("PRAGMA busy_timeout = 5000")
+        return con
+
+    @contextmanager
+    def read(self):
+        """
+        Same as "with database:" but checks out a read only connection, doesn't wait for the writer
+        Only methods that don't write may be called inside of it
+        """
+        con = self._readers.get()
+        self.con = con
+        self.cur = con.cursor()
+        try:
+            yield self
+        finally:
+            self.con = None
+            self.cur = None
+            self._readers.put(con)
+
+    def clear_identity_map(self):
+        self._user_fks = {}
+        self._server_fks = {}
+        self._memberships = set()
+        self._track_fks = {}
+
+    def get_user_fks(self, user_discord_ids: Iterable[int]) -> dict[int, int]:
+        """
+        Bulk translation of discord ids to users row ids, unknown users are left out
+        """
+        assert self.con is not None and self.cur is not None
+
+        user_discord_ids = set(user_discord_ids)
+        missing = [str(u) for u in user_discord_ids if u not in self._user_fks]
+        if len(missing) > 0:
+            for row_id, discord_id in self.cur.execute(
+                """
+                SELECT id, discord_id FROM users
+                where discord_id in (SELECT value from json_each(?))
+                """, [json.dumps(missing)]
+            ).fetchall():
+                self._user_fks[int(discord_id)] = row_id
+        return {u: self._user_fks[u] for u in user_discord_ids if u in self._user_fks}
+
+    def get_user_fk(self, user_discord_id: int) -> int:
+        user_fk = self.get_user_fks([user_discord_id]).get(user_discord_id)
+        if user_fk is None:
+            raise LookupError(f"user: {user_discord_id} not found in users table!")
+        return user_fk
+
+    def get_server_fk(self, server_discord_id: int) -> int:
+        assert self.con is not None and self.cur is not None
+
+        server_fk = self._server_fks.get(server_discord_id)
+        if server_fk is None:
+            row = self.cur.execute(
+                """
+                SELECT id FROM servers where discord_id = ?
+                """
+                , [str(server_discord_id)]
+            ).fetchone()
+            if row is None:
+                raise LookupError(f"server: {server_discord_id} not found in servers table!")
+            server_fk = self._server_fks[server_discord_id] = row[0]
+        return server_fk
+
+    def get_membership_fks(self, user_discord_id: int, server_discord_id: int) -> tuple[int, int]:
+        """
+        Returns the user and server row ids, only if the user is a member of the server
+        """
+        assert self.con is not None and self.cur is not None
+
+        user_fk, server_fk = self.get_user_fk(user_discord_id), self.get_server_fk(server_discord_id)
+        if (server_fk, user_fk) not in self._memberships:
+            if self.cur.execute(queries.MEMBERSHIP, [server_fk, user_fk]).fetchone() is None:
+                raise LookupError(f"user: {user_discord_id} is not a member of server: {server_discord_id}")
+            self._memberships.add((server_fk, user_fk))
+        return user_fk, server_fk
 
     def create_database(self):
         """
@@ -53,15 +190,7 @@ class DB:
         # Verifiy connection to database
         assert self.con is not None and self.cur is not None
 
-        owner_search = self.cur.execute(
-            """
-            SELECT * FROM users where discord_id = ?
-            """
-            , [str(owner_id)]
-        )
-        if owner_search.arraysize < 1:
-            raise Exception(f"owner_id: {owner_id} not found in users table!")
-        owner_fk = owner_search.fetchone()[0]
+        owner_fk = self.get_user_fk(owner_id)
 
         self.cur.execute(
             """
@@ -69,60 +198,80 @@ class DB:
             """
             , (server_id, server_name, owner_fk)
         )
+        if self.cur.rowcount > 0:
+            self._server_fks[server_id] = self.cur.lastrowid
 
-    def register_users(self, users: Iterable[tuple[int, str]]):
+    def register_users(self, users: Iterable[tuple[int, str]], rename: bool = True):
         assert self.con is not None and self.cur is not None
 
         users = [(str(x[0]), x[1]) for x in users]
+        if not rename:
+            self.cur.executemany("INSERT OR IGNORE INTO users (discord_id, name) values (?,?)", users)
+            return
+        # Names are only rewritten when they changed
         self.cur.executemany(
             """
-            INSERT OR IGNORE INTO users (discord_id, name) values (?,?)
+            INSERT INTO users (discord_id, name) values (?,?)
+            ON CONFLICT (discord_id) DO UPDATE SET name = excluded.name where name != excluded.name
             """
             , users
         )
 
-    def register_memberships(self, server_id: int, users: Iterable[int]):
+    def register_memberships(self, server_id: int, users: Iterable[int]) -> int:
         assert self.con is not None and self.cur is not None
 
-        server_fk = self.cur.execute(
-            """
-            SELECT id FROM servers where discord_id = ?
-            """
-            , [str(server_id)]
-        ).fetchone()[0]
-        users = [[str(u)] for u in users]
-        users_fk = []
-        for u in users:
-            users_fk.append(self.cur.execute(
-                """
-                SELECT id FROM users where discord_id in (?)
-                """
-                , u
-            ).fetchone()[0])
-
-        users_fk = [(server_fk, u, 'Default') for u in users_fk]
-        self.cur.executemany(
+        # Single set based insert instead of a lookup per member
+        self.cur.execute(
             """
-            INSERT OR IGNORE INTO user_membership (server_id, user_id, perm_level) VALUES (?, ?, ?)
+            INSERT OR IGNORE INTO user_membership (server_id, user_id, perm_level)
+            SELECT ?, id, 'Default' FROM users
+            where discord_id in (SELECT value from json_each(?))
             """
-            , users_fk
+            , [self.get_server_fk(server_id), json.dumps([str(u) for u in users])]
         )
+        return self.cur.rowcount
 
-    def remove_membership(self, server_id: int, user_id: int):
+    def sync_memberships(self, server_id: int, users: list[int]) -> tuple[int, int]:
+        """
+        Makes the memberships of the server match users, only the difference is written
+        Users must already be registered, returns how many memberships were added and removed
+        """
         assert self.con is not None and self.cur is not None
 
-        server_fk = self.cur.execute(
+        server_fk = self.get_server_fk(server_id)
+        discord_ids = json.dumps([str(u) for u in users])
+
+        self.cur.execute(
+            """
+            DELETE FROM user_membership
+            where server_id = ? and user_id not in (
+                SELECT id from users where discord_id in (SELECT value from json_each(?))
+            )
             """
-            SELECT id FROM servers where discord_id = ?
+            , [server_fk, discord_ids]
+        )
+        removed = self.cur.rowcount
+        if removed > 0:
+            self._memberships = {m for m in self._memberships if m[0] != server_fk}
+
+        self.cur.execute(
             """
-            , [str(server_id)]
-        ).fetchone()[0]
-        user_fk = self.cur.execute(
+            INSERT OR IGNORE INTO user_membership (server_id, user_id, perm_level)
+            SELECT ?, id, 'Default' FROM users
+            where discord_id in (SELECT value from json_each(?))
             """
-            SELECT id FROM users where discord_id in (?)
-            """, [str(user_id)]
-        ).fetchone()[0]
+            , [server_fk, discord_ids]
+        )
+        return self.cur.rowcount, removed
 
+    def remove_membership(self, server_id: int, user_id: int):
+        assert self.con is not None and self.cur is not None
+
+        try:
+            server_fk, user_fk = self.get_server_fk(server_id), self.get_user_fk(user_id)
+        except LookupError:
+            return  # Never registered, members only get registered on their first command unless every member is cached
+        self._memberships.discard((server_fk, user_fk))
         self.cur.execute(
             """
             DELETE FROM user_membership
@@ -130,150 +279,162 @@ class DB:
             """, [user_fk, server_fk]
         )
 
-    def register_song(self, song, user_discord_id: int, server_discord_id: int):
+    def register_track(self, yt_id: str, title: str, duration: Optional[int], thumbnail: Optional[str] = None) -> int:
+        """
+        Creates or refreshes the metadata of a track, returns its row id
+        Unknown durations are stored as 0 and never replace a known one
+        """
         assert self.con is not None and self.cur is not None
 
-        user_fk, server_fk = self.cur.execute(
-            """
-            SELECT u.id, s.id from user_membership 
-            join servers s on s.id = user_membership.server_id
-            join users u on u.id = user_membership.user_id
-            where u.discord_id = ? and s.discord_id = ? limit 1
-            """
-            , [str(user_discord_id), str(server_discord_id)]
-        ).fetchone()
-
         self.cur.execute(
             """
-            INSERT INTO songs (server, requestee, date_requested, video_id, video_name, video_len) 
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO tracks (youtube_id, title, duration, thumbnail) VALUES (?, ?, ?, ?)
+            ON CONFLICT (youtube_id) DO UPDATE SET
+                title = excluded.title,
+                duration = coalesce(nullif(excluded.duration, 0), duration),
+                thumbnail = coalesce(excluded.thumbnail, thumbnail)
             """
-            , [server_fk, user_fk, datetime.now().isoformat(), song.yt_id, song.name, song.duration]
+            , [yt_id, title, duration or 0, thumbnail]
         )
-        return self.cur.lastrowid
+        track_fk = self._track_fks.get(yt_id)
+        if track_fk is None:
+            track_fk = self._track_fks[yt_id] = self.cur.execute(
+                "SELECT id from tracks where youtube_id = ?", [yt_id]
+            ).fetchone()[0]
+        return track_fk
+
+    def get_track(self, yt_id: str) -> Optional[TrackInfo]:
+        assert self.con is not None and self.cur is not None
+
+        row = self.cur.execute(queries.TRACK, [yt_id]).fetchone()
+        if row is None:
+            return None
+        return TrackInfo(id=row[0], youtube_id=row[1], title=row[2], duration=row[3] or None, thumbnail=row[4])
 
-    def log_command(self, command: str, user_discord_id: int, server_discord_id: int):
+    def register_song(self, song, user_discord_id: int, server_discord_id: int, date: Optional[datetime] = None):
         assert self.con is not None and self.cur is not None
 
-        user_fk, server_fk = self.cur.execute(
+        user_fk, server_fk = self.get_membership_fks(user_discord_id, server_discord_id)
+        track_fk = self.register_track(song.yt_id, song.name, song.duration, song.thumbnail)
+
+        self.cur.execute(
             """
-            SELECT u.id, s.id from user_membership 
-            join servers s on s.id = user_membership.server_id
-            join users u on u.id = user_membership.user_id
-            where u.discord_id = ? and s.discord_id = ? limit 1
+            INSERT INTO songs (server, requestee, date_requested, track) VALUES (?, ?, ?, ?)
             """
-            , [str(user_discord_id), str(server_discord_id)]
-        ).fetchone()
+            , [server_fk, user_fk, (date or datetime.now()).isoformat(), track_fk]
+        )
+        song_id = self.cur.lastrowid
 
+        # Keep play count aggregates in step, within the same transaction
+        day = (date or datetime.now()).date().isoformat()
         self.cur.execute(
             """
-            INSERT INTO command_log (server, writer, command, date_issued) values (?, ?, ?, ?)
+            INSERT INTO song_plays_server (server, track, plays) VALUES (?, ?, 1)
+            ON CONFLICT (server, track) DO UPDATE SET plays = plays + 1
             """
-            , [server_fk, user_fk, command, datetime.now().isoformat()]
+            , [server_fk, track_fk]
         )
-
-    def get_top_songs_local(self, user_discord_id: int, server_discord_id: int, amount=10):
-        assert self.con is not None and self.cur is not None
-
-        amount = amount if amount < 1000 else 10
-        user_fk, server_fk = self.cur.execute(
+        self.cur.execute(
             """
-            SELECT u.id, s.id from user_membership 
-            join servers s on s.id = user_membership.server_id
-            join users u on u.id = user_membership.user_id
-            where u.discord_id = ? and s.discord_id = ? limit 1
+            INSERT INTO song_plays_user (requestee, track, plays) VALUES (?, ?, 1)
+            ON CONFLICT (requestee, track) DO UPDATE SET plays = plays + 1
             """
-            , [str(user_discord_id), str(server_discord_id)]
-        ).fetchone()
-
-        return self.cur.execute(
+            , [user_fk, track_fk]
+        )
+        self.cur.execute(
+            """
+            INSERT INTO song_plays_user_server (requestee, server, track, plays) VALUES (?, ?, ?, 1)
+            ON CONFLICT (requestee, server, track) DO UPDATE SET plays = plays + 1
             """
-            SELECT songs.video_name, songs.video_id, count(video_id) from songs
-                join users u on u.id = songs.requestee
-                join servers s on s.id = songs.server
-                where u.id = ? and s.id = ?
-                group by video_id
-                order by count(video_id) desc
-                limit ?
+            , [user_fk, server_fk, track_fk]
+        )
+        self.cur.execute(
             """
-            , [user_fk, server_fk, amount]
+            INSERT INTO song_plays_daily (day, server, requestee, track, plays) VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (day, server, requestee, track) DO UPDATE SET plays = plays + 1
+            """
+            , [day, server_fk, user_fk, track_fk]
         )
+        return song_id
 
-    def get_top_songs_global(self, user_discord_id: int, amount=10):
+    def log_command(self, command: str, user_discord_id: int, server_discord_id: int, date: Optional[datetime] = None):
         assert self.con is not None and self.cur is not None
 
-        amount = amount if amount < 1000 else 10
-        user_fk = self.cur.execute(
-            """
-            SELECT id from users
-            where discord_id = ? limit 1
-            """
-            , [str(user_discord_id)]
-        ).fetchone()[0]
+        user_fk, server_fk = self.get_membership_fks(user_discord_id, server_discord_id)
 
-        return self.cur.execute(
+        self.cur.execute(
             """
-            SELECT songs.video_name, songs.video_id, count(video_id) from songs
-                join users u on u.id = songs.requestee
-                where u.id = ?
-                group by video_id
-                order by count(video_id) desc
-                limit ?
+            INSERT INTO command_log (server, writer, command, date_issued) values (?, ?, ?, ?)
             """
-            , [user_fk, amount]
+            , [server_fk, user_fk, command, (date or datetime.now()).isoformat()]
         )
 
-    def get_top_songs_server(self, server_discord_id: int, amount=10):
+    def get_top_songs_local(self, user_discord_id: int, server_discord_id: int, amount=10, days: Optional[int] = None):
         assert self.con is not None and self.cur is not None
 
         amount = amount if amount < 1000 else 10
-        server_fk = self.cur.execute(
-            """
-            SELECT id from servers
-            where discord_id = ? limit 1
-            """
-            , [str(server_discord_id)]
-        ).fetchone()[0]
+        user_fk, server_fk = self.get_membership_fks(user_discord_id, server_discord_id)
+
+        if days is not None:
+            return self.cur.execute(queries.TOP_SONGS_LOCAL_WINDOW, [user_fk, server_fk, self.window_start(days), amount])
+        return self.cur.execute(queries.TOP_SONGS_LOCAL, [user_fk, server_fk, amount])
+
+    def get_top_songs_global(self, user_discord_id: int, amount=10, days: Optional[int] = None):
+        assert self.con is not None and self.cur is not None
+
+        amount = amount if amount < 1000 else 10
+        user_fk = self.get_user_fk(user_discord_id)
+
+        if days is not None:
+            return self.cur.execute(queries.TOP_SONGS_GLOBAL_WINDOW, [user_fk, self.window_start(days), amount])
+        return self.cur.execute(queries.TOP_SONGS_GLOBAL, [user_fk, amount])
+
+    def get_top_songs_server(self, server_discord_id: int, amount=10, days: Optional[int] = None):
+        assert self.con is not None and self.cur is not None
+
+        amount = amount if amount < 1000 else 10
+        server_fk = self.get_server_fk(server_discord_id)
+
+        if days is not None:
+            return self.cur.execute(queries.TOP_SONGS_SERVER_WINDOW, [server_fk, self.window_start(days), amount])
+        return self.cur.execute(queries.TOP_SONGS_SERVER, [server_fk, amount])
 
+    def get_top_songs_all(self, amount=10):
+        assert self.con is not None and self.cur is not None
+
+        amount = amount if amount < 1000 else 10
         return self.cur.execute(
             """
-            select songs.video_name, songs.video_id, count(video_id) from songs
-                join servers s on s.id = songs.server
-                where s.id = ?
-                group by video_id
-                order by count(video_id) desc
-                limit ?
+            SELECT t.title, t.youtube_id, p.plays from (
+                SELECT track, sum(plays) as plays from song_plays_server
+                    group by track
+                    order by sum(plays) desc
+                    limit ?
+            ) p join tracks t on t.id = p.track
+                order by p.plays desc
             """
-            , [server_fk, amount]
+            , [amount]
         )
 
+    @staticmethod
+    def window_start(days: int) -> str:
+        """
+        First day, as stored in song_plays_daily, of a window of days ending today
+        """
+        return (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+
     def get_all_user_servers(self, usr_db_id: int) -> list[int]:
         assert self.con is not None and self.cur is not None
 
         return [
             int(x[0]) for x in
-            self.cur.execute(
-                """
-                SELECT s.discord_id from user_membership
-                join servers s on s.id = user_membership.server_id
-                where user_id = ?
-                """, [usr_db_id]
-            ).fetchall()
+            self.cur.execute(queries.USER_SERVERS, [usr_db_id]).fetchall()
         ]
 
     def register_song_listeners(self, db_song_id: int, user_ids: tuple[int]):
         assert self.con is not None and self.cur is not None
 
-        user_ids = [
-            (r[0], db_song_id) for r in
-            self.cur.execute(
-                """
-                SELECT id from users
-                WHERE discord_id in (
-                """ + ",".join(["?"] * len(user_ids)) + ")",
-                user_ids
-            ).fetchall()
-        ]
+        user_ids = [(u, db_song_id) for u in self.get_user_fks(user_ids).values()]
 
         self.cur.executemany(
             """
@@ -282,18 +443,82 @@ class DB:
             """, user_ids
         )
 
+    def get_expired_command_logs(self, cutoff: datetime, amount: int) -> list[tuple]:
+        """
+        Oldest command log rows issued before cutoff
+        """
+        assert self.con is not None and self.cur is not None
+
+        return self.cur.execute(queries.EXPIRED_COMMAND_LOGS, [cutoff.isoformat(), amount]).fetchall()
+
+    def rollup_command_logs(self, log_ids: list[int]):
+        """
+        Adds the given command log rows to the daily per server counts and deletes them
+        Commands are counted by their first word, arguments are dropped
+        """
+        assert self.con is not None and self.cur is not None
+
+        self.cur.execute(
+            """
+            INSERT INTO command_log_daily (day, server, command, uses)
+            SELECT substr(date_issued, 1, 10), server, substr(command, 1, instr(command || ' ', ' ') - 1), count(*)
+                from command_log
+                where id in (SELECT value from json_each(?))
+                group by 1, 2, 3
+            ON CONFLICT (day, server, command) DO UPDATE SET uses = uses + excluded.uses
+            """
+            , [json.dumps(log_ids)]
+        )
+        self.cur.execute(
+            "DELETE from command_log where id in (SELECT value from json_each(?))", [json.dumps(log_ids)]
+        )
+
+    def get_expired_song_listeners(self, cutoff: datetime, amount: int) -> list[tuple]:
+        """
+        Oldest song listener rows of songs requested before cutoff, with the server and date of the song
+        """
+        assert self.con is not None and self.cur is not None
+
+        return self.cur.execute(queries.EXPIRED_SONG_LISTENERS, [cutoff.isoformat(), amount]).fetchall()
+
+    def rollup_song_listeners(self, listener_ids: list[int]):
+        """
+        Adds the given song listener rows to the daily per user counts and deletes them
+        """
+        assert self.con is not None and self.cur is not None
+
+        self.cur.execute(
+            """
+            INSERT INTO song_listens_daily (day, server, listener_user, listens)
+            SELECT substr(s.date_requested, 1, 10), s.server, l.listener_user, count(*)
+                from song_listener l
+                join songs s on s.id = l.song
+                where l.id in (SELECT value from json_each(?))
+                group by 1, 2, 3
+            ON CONFLICT (day, server, listener_user) DO UPDATE SET listens = listens + excluded.listens
+            """
+            , [json.dumps(listener_ids)]
+        )
+        self.cur.execute(
+            "DELETE from song_listener where id in (SELECT value from json_each(?))", [json.dumps(listener_ids)]
+        )
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """
+        Returns up to pages free pages to the OS, returns how many free pages are left
+        """
+        assert self.con is not None and self.cur is not None
+
+        self.cur.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()  # Only runs while stepped through
+        return self.cur.execute("PRAGMA freelist_count").fetchone()[0]
+
     def register_new_web_key(self, user_id: int, key: str, token: str):
         """
         Returns false if no data was inserted
         """
         assert self.con is not None and self.cur is not None
 
-        user_fk = self.cur.execute(
-            """
-            SELECT id from users
-            where discord_id = ? limit 1
-            """, [user_id]
-        ).fetchone()[0]
+        user_fk = self.get_user_fk(user_id)
 
         token_exp_date = datetime.now() + timedelta(minutes=5)
         key_exp_date = datetime.now() + timedelta(days=90)
@@ -308,19 +533,9 @@ class DB:
     def get_web_keys_status(self, user_id: int) -> Optional[WebKeyStatus]:
         assert self.con is not None and self.cur is not None
 
-        user_fk = self.cur.execute(
-            """
-            SELECT id from users
-            where discord_id = ? limit 1
-            """, [user_id]
-        ).fetchone()[0]
+        user_fk = self.get_user_fk(user_id)
 
-        status = self.cur.execute(
-            """
-            SELECT id, key_expiration_date, request_token, request_token_expiration_date, key_validated from webui_session_keys
-            WHERE discord_user = ? limit 1
-            """, [user_fk]
-        ).fetchone()
+        status = self.cur.execute(queries.WEB_KEYS_STATUS, [user_fk]).fetchone()
         if status is None:
             return None
         return WebKeyStatus(
@@ -361,12 +576,7 @@ class DB:
     def get_web_key_with_token(self, token: str):
         assert self.con is not None and self.cur is not None
 
-        status = self.cur.execute(
-            """
-            SELECT id, key_expiration_date, request_token, request_token_expiration_date, key_validated, key from webui_session_keys
-            WHERE request_token = ? limit 1
-            """, [token]
-        ).fetchone()
+        status = self.cur.execute(queries.WEB_KEY_WITH_TOKEN, [token]).fetchone()
         if status is None:
             return None
         return WebKeyStatus(
@@ -395,12 +605,7 @@ class DB:
         """
         assert self.con is not None and self.cur is not None
 
-        search = self.cur.execute(
-            """
-            SELECT discord_user, key_expiration_date, request_token, request_token_expiration_date, key_validated from webui_session_keys
-            where key = ? limit 1
-            """, [key]
-        ).fetchone()
+        search = self.cur.execute(queries.AUTH_KEY, [key]).fetchone()
 
         if search is None:
             return False, None
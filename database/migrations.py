@@ -0,0 +1,318 @@
+"""
+Versioned schema migrations, applied in order at startup to bring any savedata.db up to date
+Version 0 is the schema built by database.schema.generate()
+
+Running this module prints the query plans of the controller's hot queries:
+    python -m database.migrations [savedata.db]
+"""
+import sqlite3
+import sys
+from datetime import datetime
+from typing import Callable, Union
+
+import database.queries as queries
+
+Migration = Union[str, Callable[[sqlite3.Connection], None]]
+
+
+def normalize_tracks(con: sqlite3.Connection):
+    """
+    Moves video metadata out of songs into tracks, songs and play counts then reference tracks by id
+    """
+    con.execute(
+        """
+        CREATE TABLE "tracks" (
+            "id" INTEGER NOT NULL UNIQUE,
+            "youtube_id" TEXT NOT NULL UNIQUE,
+            "title" TEXT NOT NULL,
+            "duration" INTEGER NOT NULL,
+            "thumbnail" TEXT,
+            PRIMARY KEY("id" AUTOINCREMENT)
+        )
+        """
+    )
+    # Latest play of each video has the most up to date metadata
+    con.execute(
+        """
+        INSERT INTO tracks (youtube_id, title, duration)
+        SELECT video_id, video_name, video_len from songs
+        where id in (SELECT max(id) from songs group by video_id)
+        order by id
+        """
+    )
+
+    con.execute(
+        """
+        CREATE TABLE "songs_normalized" (
+            "id" INTEGER NOT NULL UNIQUE,
+            "server" INTEGER NOT NULL,
+            "requestee" INTEGER NOT NULL,
+            "date_requested" TEXT NOT NULL,
+            "track" INTEGER NOT NULL,
+            PRIMARY KEY("id" AUTOINCREMENT),
+            FOREIGN KEY("server") REFERENCES "servers"("id"),
+            FOREIGN KEY("requestee") REFERENCES "users"("id"),
+            FOREIGN KEY("track") REFERENCES "tracks"("id")
+        )
+        """
+    )
+    con.execute(
+        """
+        INSERT INTO songs_normalized (id, server, requestee, date_requested, track)
+        SELECT s.id, s.server, s.requestee, s.date_requested, t.id from songs s
+        join tracks t on t.youtube_id = s.video_id
+        """
+    )
+    con.execute('DROP TABLE "songs"')
+    con.execute('ALTER TABLE "songs_normalized" RENAME TO "songs"')
+    con.execute('CREATE INDEX "songs_server_track" ON "songs" ("server", "track")')
+    con.execute('CREATE INDEX "songs_requestee_track" ON "songs" ("requestee", "track")')
+
+    # Play counts are rebuilt keyed by track
+    for table in ('song_plays_server', 'song_plays_user', 'song_plays_user_server', 'song_plays_daily'):
+        con.execute(f'DROP TABLE "{table}"')
+    statements = """
+        CREATE TABLE "song_plays_server" (
+            "server" INTEGER NOT NULL,
+            "track" INTEGER NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("server", "track"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id"),
+            FOREIGN KEY ("track") REFERENCES "tracks"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_server_top" ON "song_plays_server" ("server", "plays" DESC);
+
+        CREATE TABLE "song_plays_user" (
+            "requestee" INTEGER NOT NULL,
+            "track" INTEGER NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("requestee", "track"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id"),
+            FOREIGN KEY ("track") REFERENCES "tracks"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_user_top" ON "song_plays_user" ("requestee", "plays" DESC);
+
+        CREATE TABLE "song_plays_user_server" (
+            "requestee" INTEGER NOT NULL,
+            "server" INTEGER NOT NULL,
+            "track" INTEGER NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("requestee", "server", "track"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id"),
+            FOREIGN KEY ("track") REFERENCES "tracks"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_user_server_top" ON "song_plays_user_server" ("requestee", "server", "plays" DESC);
+
+        CREATE TABLE "song_plays_daily" (
+            "day" TEXT NOT NULL,
+            "server" INTEGER NOT NULL,
+            "requestee" INTEGER NOT NULL,
+            "track" INTEGER NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("day", "server", "requestee", "track"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id"),
+            FOREIGN KEY ("track") REFERENCES "tracks"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_daily_server" ON "song_plays_daily" ("server", "day");
+        CREATE INDEX "song_plays_daily_requestee" ON "song_plays_daily" ("requestee", "day");
+
+        INSERT INTO song_plays_server (server, track, plays)
+            SELECT server, track, count(*) from songs group by server, track;
+        INSERT INTO song_plays_user (requestee, track, plays)
+            SELECT requestee, track, count(*) from songs group by requestee, track;
+        INSERT INTO song_plays_user_server (requestee, server, track, plays)
+            SELECT requestee, server, track, count(*) from songs group by requestee, server, track;
+        INSERT INTO song_plays_daily (day, server, requestee, track, plays)
+            SELECT substr(date_requested, 1, 10), server, requestee, track, count(*) from songs
+            group by substr(date_requested, 1, 10), server, requestee, track
+    """
+    for statement in statements.split(';'):
+        if statement.strip():
+            con.execute(statement)
+
+
+# (version, description, sql script or function receiving the connection), never edit an applied one
+MIGRATIONS: list[tuple[int, str, Migration]] = [
+    (1, "Indexes for top queries, memberships, command log and web key lookups", """
+        CREATE INDEX IF NOT EXISTS "songs_server_video" ON "songs" ("server", "video_id", "video_name");
+        CREATE INDEX IF NOT EXISTS "songs_requestee_video" ON "songs" ("requestee", "video_id", "video_name");
+        CREATE INDEX IF NOT EXISTS "song_listener_song" ON "song_listener" ("song");
+        CREATE INDEX IF NOT EXISTS "user_membership_user" ON "user_membership" ("user_id", "server_id");
+        CREATE INDEX IF NOT EXISTS "command_log_server_date" ON "command_log" ("server", "date_issued");
+        CREATE INDEX IF NOT EXISTS "webui_session_keys_key" ON "webui_session_keys" ("key");
+        CREATE INDEX IF NOT EXISTS "webui_session_keys_request_token" ON "webui_session_keys" ("request_token");
+    """),
+    (2, "Play count aggregates for top queries", """
+        CREATE TABLE "song_plays_server" (
+            "server" INTEGER NOT NULL,
+            "video_id" TEXT NOT NULL,
+            "video_name" TEXT NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("server", "video_id"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_server_top" ON "song_plays_server" ("server", "plays" DESC);
+
+        CREATE TABLE "song_plays_user" (
+            "requestee" INTEGER NOT NULL,
+            "video_id" TEXT NOT NULL,
+            "video_name" TEXT NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("requestee", "video_id"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_user_top" ON "song_plays_user" ("requestee", "plays" DESC);
+
+        CREATE TABLE "song_plays_user_server" (
+            "requestee" INTEGER NOT NULL,
+            "server" INTEGER NOT NULL,
+            "video_id" TEXT NOT NULL,
+            "video_name" TEXT NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("requestee", "server", "video_id"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_user_server_top" ON "song_plays_user_server" ("requestee", "server", "plays" DESC);
+
+        CREATE TABLE "song_plays_daily" (
+            "day" TEXT NOT NULL,
+            "server" INTEGER NOT NULL,
+            "requestee" INTEGER NOT NULL,
+            "video_id" TEXT NOT NULL,
+            "video_name" TEXT NOT NULL,
+            "plays" INTEGER NOT NULL,
+            PRIMARY KEY ("day", "server", "requestee", "video_id"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id"),
+            FOREIGN KEY ("requestee") REFERENCES "users"("id")
+        ) WITHOUT ROWID;
+        CREATE INDEX "song_plays_daily_server" ON "song_plays_daily" ("server", "day");
+        CREATE INDEX "song_plays_daily_requestee" ON "song_plays_daily" ("requestee", "day");
+
+        INSERT INTO song_plays_server (server, video_id, video_name, plays)
+            SELECT server, video_id, max(video_name), count(*) from songs group by server, video_id;
+        INSERT INTO song_plays_user (requestee, video_id, video_name, plays)
+            SELECT requestee, video_id, max(video_name), count(*) from songs group by requestee, video_id;
+        INSERT INTO song_plays_user_server (requestee, server, video_id, video_name, plays)
+            SELECT requestee, server, video_id, max(video_name), count(*) from songs group by requestee, server, video_id;
+        INSERT INTO song_plays_daily (day, server, requestee, video_id, video_name, plays)
+            SELECT substr(date_requested, 1, 10), server, requestee, video_id, max(video_name), count(*) from songs
+            group by substr(date_requested, 1, 10), server, requestee, video_id;
+    """),
+    (3, "Normalize video metadata into tracks", normalize_tracks),
+    (4, "Daily rollups and date indexes for retention", """
+        CREATE TABLE "command_log_daily" (
+            "day" TEXT NOT NULL,
+            "server" INTEGER NOT NULL,
+            "command" TEXT NOT NULL,
+            "uses" INTEGER NOT NULL,
+            PRIMARY KEY ("day", "server", "command"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id")
+        ) WITHOUT ROWID;
+
+        CREATE TABLE "song_listens_daily" (
+            "day" TEXT NOT NULL,
+            "server" INTEGER NOT NULL,
+            "listener_user" INTEGER NOT NULL,
+            "listens" INTEGER NOT NULL,
+            PRIMARY KEY ("day", "server", "listener_user"),
+            FOREIGN KEY ("server") REFERENCES "servers"("id"),
+            FOREIGN KEY ("listener_user") REFERENCES "users"("id")
+        ) WITHOUT ROWID;
+
+        CREATE INDEX "command_log_date" ON "command_log" ("date_issued");
+        CREATE INDEX "songs_date" ON "songs" ("date_requested");
+    """),
+]
+
+INCREMENTAL_VACUUM = 2  # PRAGMA auto_vacuum value
+
+# Hot queries of DB, the statements it runs
+QUERY_PLAN_CHECKS: dict[str, str] = {
+    "get_top_songs_local": queries.TOP_SONGS_LOCAL,
+    "get_top_songs_local (days)": queries.TOP_SONGS_LOCAL_WINDOW,
+    "get_top_songs_global": queries.TOP_SONGS_GLOBAL,
+    "get_top_songs_global (days)": queries.TOP_SONGS_GLOBAL_WINDOW,
+    "get_top_songs_server": queries.TOP_SONGS_SERVER,
+    "get_top_songs_server (days)": queries.TOP_SONGS_SERVER_WINDOW,
+    "get_expired_command_logs": queries.EXPIRED_COMMAND_LOGS,
+    "get_expired_song_listeners": queries.EXPIRED_SONG_LISTENERS,
+    "get_track": queries.TRACK,
+    "get_membership_fks": queries.MEMBERSHIP,
+    "get_all_user_servers": queries.USER_SERVERS,
+    "auth_key": queries.AUTH_KEY,
+    "get_web_key_with_token": queries.WEB_KEY_WITH_TOKEN,
+    "get_web_keys_status": queries.WEB_KEYS_STATUS,
+}
+
+
+def get_version(con: sqlite3.Connection) -> int:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "schema_version" (
+            "version" INTEGER NOT NULL UNIQUE,
+            "description" TEXT NOT NULL,
+            "date_applied" TEXT NOT NULL
+        )
+        """
+    )
+    con.commit()
+    return con.execute("SELECT coalesce(max(version), 0) from schema_version").fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection):
+    """
+    Applies every migration newer than the database's version, each one in its own transaction
+    """
+    version = get_version(con)
+    for m_version, description, migration in MIGRATIONS:
+        if m_version <= version:
+            continue
+        print(f"Info: Migrating database to version {m_version}: {description}")
+        try:
+            con.execute("BEGIN")
+            if callable(migration):
+                migration(con)
+            else:
+                # executescript would commit the open transaction, run statements one by one instead
+                for statement in migration.split(';'):
+                    if statement.strip():
+                        con.execute(statement)
+            con.execute(
+                "INSERT INTO schema_version (version, description, date_applied) VALUES (?, ?, ?)",
+                (m_version, description, datetime.now().isoformat())
+            )
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    # auto_vacuum can't change inside a transaction and only takes effect once the file is rebuilt
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL_VACUUM:
+        print("Info: Enabling incremental vacuum, rebuilding the database once")
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+
+
+def explain_queries(con: sqlite3.Connection) -> dict[str, list[str]]:
+    """
+    Returns the EXPLAIN QUERY PLAN output of every hot query
+    Parameters are bound to placeholder values, only the plan matters
+    """
+    return {
+        name: [row[-1] for row in con.execute(f"EXPLAIN QUERY PLAN {sql}", [1] * sql.count('?')).fetchall()]
+        for name, sql in QUERY_PLAN_CHECKS.items()
+    }
+
+
+if __name__ == '__main__':
+    connection = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'savedata.db')
+    for query_name, plan in explain_queries(connection).items():
+        # Scans, even of an index, grow with the table. Limited subqueries that got materialized don't
+        materialized = {p.split()[1] for p in plan if p.startswith('MATERIALIZE')}
+        full_scan = any(p.startswith('SCAN') and p.split()[1] not in materialized for p in plan)
+        print(f"{'Warning' if full_scan else 'Info'}: {query_name}")
+        for p in plan:
+            print(f"    {p}")
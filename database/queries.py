@@ -0,0 +1,87 @@
+"""
+Statements of the hot queries, shared by the controller running them and the query plan checks explaining them
+"""
+
+TOP_SONGS_LOCAL = """
+    SELECT t.title, t.youtube_id, p.plays from song_plays_user_server p
+        join tracks t on t.id = p.track
+        where p.requestee = ? and p.server = ?
+        order by p.plays desc
+        limit ?
+"""
+TOP_SONGS_LOCAL_WINDOW = """
+    SELECT t.title, t.youtube_id, p.plays from (
+        SELECT track, sum(plays) as plays from song_plays_daily
+            where requestee = ? and server = ? and day >= ?
+            group by track
+            order by sum(plays) desc
+            limit ?
+    ) p join tracks t on t.id = p.track
+        order by p.plays desc
+"""
+TOP_SONGS_GLOBAL = """
+    SELECT t.title, t.youtube_id, p.plays from song_plays_user p
+        join tracks t on t.id = p.track
+        where p.requestee = ?
+        order by p.plays desc
+        limit ?
+"""
+TOP_SONGS_GLOBAL_WINDOW = """
+    SELECT t.title, t.youtube_id, p.plays from (
+        SELECT track, sum(plays) as plays from song_plays_daily
+            where requestee = ? and day >= ?
+            group by track
+            order by sum(plays) desc
+            limit ?
+    ) p join tracks t on t.id = p.track
+        order by p.plays desc
+"""
+TOP_SONGS_SERVER = """
+    SELECT t.title, t.youtube_id, p.plays from song_plays_server p
+        join tracks t on t.id = p.track
+        where p.server = ?
+        order by p.plays desc
+        limit ?
+"""
+TOP_SONGS_SERVER_WINDOW = """
+    SELECT t.title, t.youtube_id, p.plays from (
+        SELECT track, sum(plays) as plays from song_plays_daily
+            where server = ? and day >= ?
+            group by track
+            order by sum(plays) desc
+            limit ?
+    ) p join tracks t on t.id = p.track
+        order by p.plays desc
+"""
+EXPIRED_COMMAND_LOGS = """
+    SELECT id, server, writer, command, date_issued from command_log
+        where date_issued < ?
+        order by date_issued
+        limit ?
+"""
+EXPIRED_SONG_LISTENERS = """
+    SELECT l.id, l.listener_user, l.song, s.server, s.date_requested from song_listener l
+        join songs s on s.id = l.song
+        where l.song <= (SELECT max(id) from songs where date_requested < ?)
+        order by l.song
+        limit ?
+"""
+TRACK = "SELECT id, youtube_id, title, duration, thumbnail from tracks where youtube_id = ?"
+MEMBERSHIP = "SELECT 1 FROM user_membership where server_id = ? and user_id = ?"
+USER_SERVERS = """
+    SELECT s.discord_id from user_membership
+        join servers s on s.id = user_membership.server_id
+        where user_id = ?
+"""
+WEB_KEYS_STATUS = """
+    SELECT id, key_expiration_date, request_token, request_token_expiration_date, key_validated from webui_session_keys
+        WHERE discord_user = ? limit 1
+"""
+WEB_KEY_WITH_TOKEN = """
+    SELECT id, key_expiration_date, request_token, request_token_expiration_date, key_validated, key from webui_session_keys
+        WHERE request_token = ? limit 1
+"""
+AUTH_KEY = """
+    SELECT discord_user, key_expiration_date, request_token, request_token_expiration_date, key_validated from webui_session_keys
+        where key = ? limit 1
+"""
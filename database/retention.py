@@ -0,0 +1,107 @@
+"""
+Background maintenance keeping append only tables bounded
+Raw command logs and song listeners older than the retention window are rolled up into daily counts,
+archived to gzipped json lines files and deleted, then the freed pages are returned to the OS
+"""
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable
+
+from config import config
+from database.db_controller import database
+
+
+class RetentionJob:
+    def __init__(self, retention_days: int, interval: float, batch_size: int, archive_dir: str, vacuum_pages: int):
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+        self.vacuum_pages = vacuum_pages
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        if self.is_enabled():
+            self._thread.start()
+
+    def is_enabled(self) -> bool:
+        return self.retention_days > 0
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                self.run_once()
+            except Exception as exc:
+                print(f"Error: Database maintenance failed. Details: {exc}")
+            self._closed.wait(self.interval)
+
+    def run_once(self):
+        cutoff = datetime.now() - timedelta(days=self.retention_days)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        commands = self.archive_table(
+            os.path.join(self.archive_dir, f"command_log-{stamp}.jsonl.gz"),
+            ('id', 'server', 'writer', 'command', 'date_issued'),
+            lambda: database.get_expired_command_logs(cutoff, self.batch_size),
+            database.rollup_command_logs
+        )
+        listeners = self.archive_table(
+            os.path.join(self.archive_dir, f"song_listener-{stamp}.jsonl.gz"),
+            ('id', 'listener_user', 'song', 'server', 'date_requested'),
+            lambda: database.get_expired_song_listeners(cutoff, self.batch_size),
+            database.rollup_song_listeners
+        )
+        pages = self.vacuum()
+        if commands or listeners or pages:
+            print(f"Info: Database maintenance archived {commands} command logs and {listeners} song listeners, freed {pages} pages")
+
+    def archive_table(self, path: str, columns: tuple[str, ...], fetch: Callable[[], list[tuple]], rollup: Callable[[list[int]], None]) -> int:
+        """
+        Moves expired rows to the archive batch by batch, the writer is only held for one batch at a time
+        The first column of the rows must be their id
+        """
+        archived = 0
+        while not self._closed.is_set():
+            with database.read():
+                rows = fetch()
+            if len(rows) == 0:
+                break
+            # Rows are on disk before they're deleted, a crash in between archives them twice at worst
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row))) + '\n')
+            with database:
+                rollup([row[0] for row in rows])
+            archived += len(rows)
+        return archived
+
+    def vacuum(self) -> int:
+        freed = 0
+        while not self._closed.is_set():
+            with database:
+                before = database.cur.execute("PRAGMA freelist_count").fetchone()[0]
+                left = database.incremental_vacuum(self.vacuum_pages)
+            freed += before - left
+            if left == 0 or before == left:
+                break
+        return freed
+
+    def close(self):
+        """
+        Stops the background thread after the batch it's working on
+        """
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+retention_job = RetentionJob(
+    config.database.retention_days,
+    config.database.retention_interval,
+    config.database.retention_batch_size,
+    config.database.archive_dir,
+    config.database.vacuum_pages
+)
@@ -0,0 +1,115 @@
+"""
+Write-behind queue for append only telemetry (command logs, song plays and their listeners)
+Writes are buffered in memory and flushed in batched transactions by size or time
+"""
+import threading
+from datetime import datetime
+from queue import Queue, Empty, Full
+from typing import Callable, Optional
+
+from config import config
+from database.db_controller import database, DB
+
+
+class SongRecord:
+    """
+    POD-like class with the song data DB.register_song expects
+    """
+    def __init__(self, yt_id: str, name: str, duration: Optional[int], thumbnail: Optional[str] = None):
+        self.yt_id = yt_id
+        self.name = name
+        self.duration = duration
+        self.thumbnail = thumbnail
+
+
+class WriteBehindQueue:
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: Queue[Callable[[DB], None]] = Queue(maxsize=max_pending)
+        self._closed = threading.Event()
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def submit(self, write: Callable[[DB], None]):
+        """
+        Never blocks, writes are dropped once the buffer is full
+        """
+        try:
+            self._pending.put_nowait(write)
+        except Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                print(f"Warning: Telemetry buffer full, {self.dropped} writes dropped so far")
+
+    def log_command(self, command: str, user_discord_id: int, server_discord_id: int):
+        date = datetime.now()
+        self.submit(lambda db: db.log_command(command, user_discord_id, server_discord_id, date))
+
+    def register_song_play(self, song: SongRecord, user_discord_id: int, server_discord_id: int, listener_ids: list[int]):
+        date = datetime.now()
+        self.submit(lambda db: db.register_song_listeners(
+            db.register_song(song, user_discord_id, server_discord_id, date),
+            listener_ids
+        ))
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                batch = [self._pending.get(timeout=self.flush_interval)]
+            except Empty:
+                continue
+            # Give writes that come shortly after the first one a chance to join the transaction,
+            # a batch that's already full is flushed right away
+            if self._pending.qsize() < self.batch_size - 1:
+                self._closed.wait(self.flush_interval)
+            batch.extend(self._drain(self.batch_size - 1))
+            try:
+                self._write(batch)
+            except Exception as exc:
+                print(f"Error: Telemetry batch of {len(batch)} writes lost. Details: {exc}")
+
+    def _drain(self, amount: int) -> list[Callable[[DB], None]]:
+        ret = []
+        while len(ret) < amount:
+            try:
+                ret.append(self._pending.get_nowait())
+            except Empty:
+                break
+        return ret
+
+    def _write(self, batch: list[Callable[[DB], None]]):
+        with database:
+            # Savepoints outside of a transaction commit on release, they have to nest in a single one
+            database.cur.execute("BEGIN")
+            for write in batch:
+                # Savepoints keep a single failing write from rolling back the whole batch
+                database.cur.execute("SAVEPOINT write_behind")
+                try:
+                    write(database)
+                    database.cur.execute("RELEASE write_behind")
+                except Exception as exc:
+                    database.cur.execute("ROLLBACK TO write_behind")
+                    database.cur.execute("RELEASE write_behind")
+                    database.clear_identity_map()  # Rows it learned about in the savepoint are gone
+                    print(f"Error: Telemetry write failed. Details: {exc}")
+
+    def close(self):
+        """
+        Stops the background thread and flushes everything still buffered
+        """
+        self._closed.set()
+        self._thread.join()
+        while True:
+            batch = self._drain(self.batch_size)
+            if len(batch) == 0:
+                break
+            self._write(batch)
+
+
+telemetry_writer = WriteBehindQueue(
+    config.database.write_batch_size,
+    config.database.write_flush_interval,
+    config.database.write_max_pending
+)
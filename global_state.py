@@ -8,6 +8,8 @@ import asyncio
 
 from bot.discord_server import Server
 
+# Copy on write, readers never lock and only ever see a complete map.
+# Writers hold the lock and replace the whole map instead of mutating it.
 guild_server_map_lock = asyncio.Lock()
 guild_server_map: dict[int, Server] = {}
 
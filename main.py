@@ -1,5 +1,7 @@
 from bot import discord_app
 from config import config
+from database.retention import retention_job
+from database.write_behind import telemetry_writer
 
 from flask import Flask
 import api
@@ -16,4 +18,8 @@ def run_flask():
 flask_thread = threading.Thread(target=run_flask, daemon=True)
 flask_thread.start()
 
-asyncio.run(discord_app.setup())
+try:
+    asyncio.run(discord_app.setup())
+finally:
+    retention_job.close()
+    telemetry_writer.close()
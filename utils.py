@@ -1,20 +1,13 @@
+import asyncio
 from concurrent.futures import ThreadPoolExecutor, Future
 
 
-def get_function_default_args(func):
-    return {
-        k: v for k, v
-        in zip(
-            [
-                x for i, x in enumerate(func.__code__.co_varnames)
-                if i >= func.__code__.co_argcount - len(func.__defaults__)
-            ],
-            func.__defaults__
-        )
-    }
-
-
-def make_class_methods_threaded():
+def make_class_methods_threaded(awaitable: bool = False):
+    """
+    Makes every method of the decorated class run on a single dedicated thread, returning a Future
+    If awaitable, methods return asyncio futures instead and must be called from the event loop
+    Methods must not call each other through self, they would wait on their own thread
+    """
     def wrapper(cls):
         cls_init = cls.__init__
 
@@ -27,12 +20,16 @@ def make_class_methods_threaded():
             a for a in dir(cls)
             if callable(getattr(cls, a)) and not a.startswith("__")
         ]
-        for m in cls_method_names:
-            prev_method = getattr(cls, m)
 
+        # Factory so that each wrapper binds its own method instead of the loop's last one
+        def make_threaded_method(prev_method):
             def threaded_method(self, *args, **kwargs) -> Future:
-                return self._threadpool.submit(prev_method, self, *args, **kwargs)
-            setattr(cls, m, threaded_method)
+                future = self._threadpool.submit(prev_method, self, *args, **kwargs)
+                return asyncio.wrap_future(future) if awaitable else future
+            return threaded_method
+
+        for m in cls_method_names:
+            setattr(cls, m, make_threaded_method(getattr(cls, m)))
         return cls
 
     return wrapper